@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Бенчмарки анализатора логов.
+
+Команды:
+    generate - детерминированный генератор логов nginx-access-ui заданного размера
+    run      - замер этапов обработки лога так же, как в main() (список файлов, разбор,
+               подготовка данных, создание отчета) и отдельно распаковки, pars_log и агрегации,
+               с сохранением результата в JSON
+    parsers  - микро-бенчмарк парсеров строки
+    gzip     - сравнение способов распаковки архивов
+
+Примеры:
+    python benchmark.py generate -o ./bench_log --size 500 --urls 50000 --gzip
+    python benchmark.py run --log-dir ./bench_log --output bench.json --compare old_bench.json
+    python benchmark.py parsers -n 200000
+    python benchmark.py gzip --gzip-size 300
+"""
+from typing import Any, Callable, Optional
+
+import gzip
+import json
+import math
+import optparse
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from datetime import date, datetime, timedelta
+
+from log_analyzer import (
+    CONFIG,
+    GZIP_BACKENDS,
+    PARSER_VERSION,
+    Metrics,
+    aggregate_lines,
+    build_log_stats,
+    create_log_stats,
+    create_report,
+    get_data_for_render,
+    get_log_files,
+    get_parser,
+    pars_log,
+    pars_log_bytes,
+    pars_log_fields,
+    unpack_file
+)
+
+
+SAMPLE_LINES = [
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n',
+    '1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] "GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" "1498697422-32900793-4708-9752770" "-" 0.133\n',
+    '1.194.135.240 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/group/7786679/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28 HTTP/1.1" 200 22 "-" "python-requests/2.13.0" "-" "1498697422-3979856266-4708-9752772" "8a7741a54297568b" 0.067\n',
+    '1.166.85.48 -  - [29/Jun/2017:03:50:22 +0300] "GET /export/appinstall_raw/2017-06-29/ HTTP/1.0" 200 28358 "-" "Mozilla/5.0 (Windows; U; Windows NT 6.0; ru; rv:1.9.0.12) Gecko/2009070611 Firefox/3.0.12 (.NET CLR 3.5.30729)" "-" "-" "-" 0.003\n',
+]
+# Парсер и признак того, что он принимает декодированные строки
+PARSERS: dict[str, tuple[Callable, bool]] = {
+    'regex': (pars_log, True),
+    'fields': (pars_log_fields, True),
+    'bytes': (pars_log_bytes, False),
+}
+# Шаблоны урлов генератора; {id} заменяется случайным идентификатором
+URL_TEMPLATES = [
+    '/api/v2/banner/{id}',
+    '/api/v2/banner/{id}/statistic/?date_from=2017-06-29&date_to=2017-06-29',
+    '/api/v2/group/{id}/banners',
+    '/api/v2/group/{id}/statistic/sites/?date_type=week&date_to=2017-07-02&date_from=2017-06-26',
+    '/api/1/campaigns/?id={id}',
+    '/api/v2/slot/{id}/groups',
+    '/api/v2/internal/banner/{id}/info',
+    '/agency/outgoings_stats/?date1=29-06-2017&date2=29-06-2017&date_type=day&do=1&rt=banner&oi={id}&as_json=1',
+    '/export/appinstall_raw/2017-06-29/',
+]
+USER_AGENTS = [
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Python-urllib/2.7',
+    'python-requests/2.13.0',
+    'Slotovod',
+    'Configovod',
+    '-',
+]
+LINE_TEMPLATE = (
+    '{ip} {user}  - [{time} +0300] "{method} {url} HTTP/1.1" {status} {size} "-" "{agent}" "-" '
+    '"{request_id}" "{rb_user}" {request_time:.3f}\n'
+)
+
+
+def get_log_name(day: date, compress: bool) -> str:
+    return f"nginx-access-ui.log-{day:%Y%m%d}" + ('.gz' if compress else '')
+
+
+def generate_log(
+        path: str,
+        size_mb: float,
+        urls: int = 10000,
+        latency_mu: float = -2.0,
+        latency_sigma: float = 1.2,
+        seed: int = 0,
+        compress: bool = False
+) -> int:
+    """
+    Пишет лог в формате nginx-access-ui размером не меньше size_mb мегабайт (до сжатия).
+    Содержимое полностью определяется параметрами и seed.
+    Урлы выбираются из набора из urls различных значений с распределением Ципфа
+    (частые "горячие" урлы и длинный хвост), request_time - логнормальное распределение
+    с параметрами latency_mu и latency_sigma, округленное до миллисекунд, как у nginx.
+    Возвращает количество записанных строк.
+    """
+    rnd = random.Random(seed)
+    url_pool = [
+        rnd.choice(URL_TEMPLATES).replace('{id}', str(rnd.randrange(10 ** 6, 10 ** 8)))
+        for _ in range(urls)
+    ]
+    cum_weights = []
+    total = 0.0
+    for i in range(urls):
+        total += 1 / (i + 1)
+        cum_weights.append(total)
+
+    size_limit = int(size_mb * 1024 * 1024)
+    written = lines = 0
+    start_time = datetime(2017, 6, 29, 3, 50, 22)
+    open_fn: Callable = gzip.open if compress else open
+    with open_fn(path, 'wt') as f:
+        while written < size_limit:
+            batch = []
+            for url in rnd.choices(url_pool, cum_weights=cum_weights, k=1000):
+                batch.append(LINE_TEMPLATE.format(
+                    ip='.'.join(str(rnd.randrange(1, 255)) for _ in range(4)),
+                    user=rnd.choice(('-', f'{rnd.getrandbits(52):x}')),
+                    time=(start_time + timedelta(seconds=lines // 100)).strftime('%d/%b/%Y:%H:%M:%S'),
+                    method=rnd.choice(('GET', 'GET', 'GET', 'POST')),
+                    url=url,
+                    status=rnd.choice((200, 200, 200, 200, 404, 500)),
+                    size=rnd.randrange(10, 30000),
+                    agent=rnd.choice(USER_AGENTS),
+                    request_id=f'{1498697422 + lines // 100}-{rnd.getrandbits(32)}-4708-{lines}',
+                    rb_user=f'{rnd.getrandbits(48):x}',
+                    request_time=rnd.lognormvariate(latency_mu, latency_sigma),
+                ))
+                lines += 1
+            data = ''.join(batch)
+            f.write(data)
+            written += len(data)
+    return lines
+
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS - байты
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def get_speed(lines: int, size: float, seconds: float) -> dict[str, float]:
+    return {
+        'lines_per_second': lines / seconds if seconds else 0,
+        'mb_per_second': size / 1024 / 1024 / seconds if seconds else 0,
+    }
+
+
+def time_parse_stages(log: str, conf: dict) -> dict[str, dict[str, float]]:
+    """
+    Раскладка разбора на этапы по трем потоковым проходам по логу в одном процессе:
+    только чтение с распаковкой через GZIP_BACKEND (decompress), то же с разбором строк
+    парсером без агрегации и то же с агрегацией. Время pars_log и aggregate - разница
+    соседних проходов.
+    """
+    parser = get_parser(conf)
+    gzip_backend = str(conf['GZIP_BACKEND'])
+
+    start_time = time.perf_counter()
+    size = lines = 0
+    for line in unpack_file(log, decode=False, gzip_backend=gzip_backend):
+        size += len(line)
+        lines += 1
+    read_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for line in unpack_file(log, decode=False, gzip_backend=gzip_backend):
+        parser(line)
+    parse_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    aggregate_lines(unpack_file(log, decode=False, gzip_backend=gzip_backend), parser, create_log_stats(conf))
+    aggregate_seconds = time.perf_counter() - start_time
+
+    pars_log_seconds = max(parse_seconds - read_seconds, 0)
+    return {
+        'decompress': {'seconds': read_seconds, **get_speed(lines, size, read_seconds)},
+        'pars_log': {'seconds': pars_log_seconds, **get_speed(lines, size, pars_log_seconds)},
+        'aggregate': {'seconds': max(aggregate_seconds - parse_seconds, 0)},
+    }
+
+
+def run_benchmark(log_dir: str, report_size: int = 1000, median_mode: str = 'exact') -> dict[str, Any]:
+    """
+    Обрабатывает самый новый лог в log_dir теми же функциями, что и main(), с настройками
+    CONFIG по умолчанию (способ распаковки, mmap, WORKERS), но без кэша агрегатов, и замеряет
+    этапы через Metrics: listing - get_log_files, parse - build_log_stats (чтение, распаковка,
+    разбор и агрегация), render - get_data_for_render, report - create_report.
+    Этапы decompress, pars_log и aggregate замеряются отдельными проходами (time_parse_stages)
+    и в total_seconds не входят.
+    """
+    conf = {**CONFIG, 'REPORT_SIZE': report_size, 'MEDIAN_MODE': median_mode, 'CACHE_DIR': ''}
+    metrics = Metrics()
+
+    log = get_log_files(log_dir, metrics)[0].filename
+    log_stats = build_log_stats(log, conf, metrics)
+    data = get_data_for_render(log_stats, report_size, metrics)
+    with tempfile.TemporaryDirectory() as report_dir:
+        create_report('report-benchmark.html', data or [], report_dir, metrics)
+    parse_stages = time_parse_stages(log, conf)
+
+    # Для несжатого лога, прочитанного через mmap, распакованный размер равен размеру файла
+    size = metrics.values.get('bytes_decompressed') or metrics.values['bytes_read']
+    stages: dict[str, dict[str, float]] = {name: {'seconds': seconds} for name, seconds in metrics.stages.items()}
+    stages['parse'].update(get_speed(log_stats.requests_count, size, stages['parse']['seconds']))
+
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parser_version': PARSER_VERSION,
+        'log': os.path.basename(log),
+        'log_size_mb': size / 1024 / 1024,
+        'lines': log_stats.requests_count,
+        'parsed': log_stats.parsed_count,
+        'urls': len(log_stats.urls),
+        'total_seconds': sum(stage['seconds'] for stage in stages.values()),
+        'peak_rss_mb': get_peak_rss_mb(),
+        'stages': {'listing': stages.pop('listing'), **parse_stages, **stages},
+    }
+
+
+def print_benchmark(result: dict[str, Any], baseline: Optional[dict[str, Any]] = None):
+    print(f"{result['log']}: {result['log_size_mb']:.1f} MB, {result['lines']:,} строк, {result['urls']:,} урлов")
+    for name, stage in result['stages'].items():
+        line = f"{name:>11}: {stage['seconds']:>9.3f} s"
+        if 'lines_per_second' in stage:
+            line += f" {stage['lines_per_second']:>12,.0f} lines/s {stage['mb_per_second']:>8,.1f} MB/s"
+        if baseline and (old := baseline['stages'].get(name)) and old['seconds']:
+            line += f"   x{stage['seconds'] / old['seconds']:.2f} к базовому"
+        print(line)
+    print(f"{'total':>11}: {result['total_seconds']:>9.3f} s, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+
+def bench_parser(parser: Callable, lines: list) -> float:
+    """Возвращает скорость разбора в строках в секунду."""
+    seconds = timeit.timeit(lambda: [parser(line) for line in lines], number=1)
+    return len(lines) / seconds
+
+
+def bench_gzip_backend(log: str, gzip_backend: str) -> tuple[float, float]:
+    """Возвращает скорость распаковки с построчным чтением: (МБ/с распакованных данных, строк/с)."""
+    start_time = time.perf_counter()
+    size = lines = 0
+    for line in unpack_file(log, decode=False, gzip_backend=gzip_backend):
+        size += len(line)
+        lines += 1
+    seconds = time.perf_counter() - start_time
+    return size / 1024 / 1024 / seconds, lines / seconds
+
+
+def command_generate(argv: list[str]):
+    args_parser = optparse.OptionParser(usage='%prog generate [options]')
+    args_parser.add_option('-o', '--output', dest='output', default='./bench_log',
+                           help="Директория для сгенерированного лога")
+    args_parser.add_option('--size', dest='size', type='float', default=100,
+                           help="Размер лога в МБ до сжатия")
+    args_parser.add_option('--urls', dest='urls', type='int', default=10000,
+                           help="Количество различных урлов")
+    args_parser.add_option('--latency-mu', dest='latency_mu', type='float', default=-2.0,
+                           help="Параметр mu логнормального распределения request_time")
+    args_parser.add_option('--latency-sigma', dest='latency_sigma', type='float', default=1.2,
+                           help="Параметр sigma логнормального распределения request_time")
+    args_parser.add_option('--seed', dest='seed', type='int', default=0)
+    args_parser.add_option('--gzip', dest='gzip', action='store_true', default=False,
+                           help="Сжать лог в .gz")
+    args_parser.add_option('--date', dest='date', default='2017-06-30',
+                           help="Дата лога ГГГГ-ММ-ДД, используется в имени файла")
+    args, _ = args_parser.parse_args(argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    day = datetime.strptime(args.date, '%Y-%m-%d').date()
+    path = os.path.join(args.output, get_log_name(day, args.gzip))
+    lines = generate_log(path, args.size, args.urls, args.latency_mu, args.latency_sigma, args.seed, args.gzip)
+    print(f'{path}: {lines:,} строк, {os.path.getsize(path) / 1024 / 1024:.1f} MB на диске')
+
+
+def command_run(argv: list[str]):
+    args_parser = optparse.OptionParser(usage='%prog run [options]')
+    args_parser.add_option('--log-dir', dest='log_dir', default='./bench_log',
+                           help="Директория с логом, см. команду generate")
+    args_parser.add_option('--report-size', dest='report_size', type='int', default=CONFIG['REPORT_SIZE'])
+    args_parser.add_option('--median-mode', dest='median_mode', default=CONFIG['MEDIAN_MODE'])
+    args_parser.add_option('--output', dest='output', default='',
+                           help="Файл для сохранения результата в JSON")
+    args_parser.add_option('--compare', dest='compare', default='',
+                           help="JSON с результатом предыдущего запуска для сравнения")
+    args, _ = args_parser.parse_args(argv)
+
+    result = run_benchmark(args.log_dir, args.report_size, args.median_mode)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_benchmark(result, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+def command_parsers(argv: list[str]):
+    args_parser = optparse.OptionParser(usage='%prog parsers [options]')
+    args_parser.add_option('-n', '--lines', dest='lines', type='int', default=200000,
+                           help="Количество строк для разбора")
+    args, _ = args_parser.parse_args(argv)
+
+    lines = (SAMPLE_LINES * math.ceil(args.lines / len(SAMPLE_LINES)))[:args.lines]
+    raw_lines = [line.encode() for line in lines]
+    for name, (parser, decode) in PARSERS.items():
+        speed = bench_parser(parser, lines if decode else raw_lines)
+        print(f'{name:>8}: {speed:>12,.0f} lines/s')
+
+
+def command_gzip(argv: list[str]):
+    args_parser = optparse.OptionParser(usage='%prog gzip [options]')
+    args_parser.add_option('--gzip-size', dest='gzip_size', type='float', default=300,
+                           help="Размер распакованного тестового архива в МБ")
+    args, _ = args_parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log = os.path.join(tmp_dir, get_log_name(date(2017, 6, 30), True))
+        generate_log(log, args.gzip_size, compress=True)
+        print(f'gzip {args.gzip_size:.0f} MB, архив {os.path.getsize(log) / 1024 / 1024:.1f} MB')
+        for gzip_backend in GZIP_BACKENDS:
+            if gzip_backend == 'pigz' and not shutil.which('pigz') or gzip_backend == 'zcat' and not shutil.which('gzip'):
+                continue
+            mb_per_second, lines_per_second = bench_gzip_backend(log, gzip_backend)
+            print(f'{gzip_backend:>8}: {mb_per_second:>8,.1f} MB/s {lines_per_second:>12,.0f} lines/s')
+
+
+COMMANDS = {
+    'generate': command_generate,
+    'run': command_run,
+    'parsers': command_parsers,
+    'gzip': command_gzip,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(__doc__)
+        sys.exit(1)
+    COMMANDS[sys.argv[1]](sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
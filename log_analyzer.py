@@ -1,46 +1,222 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from typing import Any, Callable, Generator, NamedTuple, Optional
+from typing import Any, BinaryIO, Callable, Generator, Iterable, NamedTuple, Optional, Pattern, TextIO, cast
 
 import configparser
 import copy
+import cProfile
+import glob
 import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
+import mmap
 import optparse
 import os
+import pickle
+import queue
 import re
+import resource
 import shutil
-import statistics
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
-from collections import Counter, namedtuple
+import zlib
+from array import array
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import date, datetime
+from functools import lru_cache
+from itertools import islice, zip_longest
 from logging import getLogger
 from logging.config import dictConfig
-from string import Template
 
 from conf.logging import get_logging_config
 
 
 logger = getLogger("log-analyzer")
-File = namedtuple('File', 'filename date')
+metrics_logger = getLogger("log-analyzer.metrics")
+File = NamedTuple('File', [('filename', str), ('date', date)])
+# Логи всех источников LOG_DIRS за один день
+FleetDay = NamedTuple('FleetDay', [('filenames', list[str]), ('date', date)])
 
 LOG_COMPILED = re.compile(
     r'.* .*  .* \[.*\] \".* (?P<url>.*) .*\" .* .* \".*\" \".*\" \".*\" \".*\" \".*\" (?P<request_time>.*)'
 )
+# Байтовый вариант для строк без декодирования. Шаблон привязан к началу и концу строки
+# и не выходит за ее границу, поэтому подходит и для отдельной строки (match),
+# и для поиска по всему файлу (finditer по mmap):
+# $request - первое поле в кавычках после [$time_local], $request_time - последнее поле
+LOG_BYTES_COMPILED = re.compile(
+    rb'^[^\[\n]*\[[^\]\n]*\] "[^ "\n]* (?P<url>[^"\n]*) [^ "\n]*"[^\n]* (?P<request_time>[^ \r\n]+)\r?$',
+    re.MULTILINE,
+)
+# log_format по умолчанию (LOG_FORMAT), под который написан LOG_BYTES_COMPILED
+DEFAULT_LOG_FORMAT = (
+    '$remote_addr $remote_user  $http_x_real_ip [$time_local] "$request" $status $body_bytes_sent '
+    '"$http_referer" "$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+    '$request_time'
+)
+LOG_FORMAT_VARIABLE_COMPILED = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+# Переменные log_format, из которых берется урл, в порядке предпочтения
+LOG_FORMAT_URL_VARIABLES = ('request', 'request_uri', 'uri')
+# Измерения GROUP_BY, которые вычисляются из переменных log_format; любое другое измерение -
+# это имя переменной log_format
+GROUP_BY_DERIVED = {'method': 'request', 'status_class': 'status'}
+# Разделитель урла и значений измерений GROUP_BY в ключе агрегата. nginx экранирует
+# управляющие символы в значениях переменных, поэтому в самих значениях его быть не может
+GROUP_SEPARATOR = '\t'
 FILE_NAME_COMPILED = re.compile(r'^nginx-access-ui\.log-(?P<date>\d{8})(?P<ext>\.gz)?$')
-SERVICE_NAME_PATTERN = r'nginx-access-ui'
-TMP_REPORT_PATH = '/tmp/report.html'
+# Логи сервиса ui; остальные файлы LOG_DIR отсекаются по префиксу имени, без разбора даты
+LOG_FILE_PREFIX = 'nginx-access-ui.log-'
+REPORT_TEMPLATE_PATH = 'report.html'
+# Место в шаблоне отчета, куда подставляется имя файла с данными
+REPORT_TEMPLATE_PLACEHOLDER = '$data_file'
+# Данные отчета лежат рядом с ним в файле <имя отчета>.data.js и подключаются тегом script,
+# поэтому отчет открывается и по file://, где fetch недоступен
+REPORT_DATA_EXT = '.data.js'
+REPORT_DATA_VARIABLE = 'window.reportData'
+# Количество знаков после запятой у дробных значений в отчете
+REPORT_FLOAT_PRECISION = 3
+# Колоночный экспорт агрегатов (EXPORT_DIR), см. write_export
+EXPORT_FILE_EXT = '.agg'
+EXPORT_MAGIC = b'LAGG'
+EXPORT_VERSION = 1
+# Заголовок: сигнатура, версия, количество колонок, количество строк
+EXPORT_HEADER = struct.Struct('<4sHHQ')
+# Каталог колонок: имя, тип, сжатие, смещение данных, их размер в файле и без сжатия
+EXPORT_NAME_SIZE = 32
+EXPORT_COLUMN = struct.Struct(f'<{EXPORT_NAME_SIZE}scB6xQQQ')
+EXPORT_INT = b'q'
+EXPORT_FLOAT = b'd'
+# Строки со словарным кодированием: номера значений в словаре (uint32) и сам словарь
+EXPORT_DICT = b'U'
+EXPORT_CODEC_RAW = 0
+EXPORT_CODEC_ZLIB = 1
+# Выравнивание данных колонок, чтобы массивы читались из mmap без копирования
+EXPORT_ALIGN = 8
 CONFIG = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log"
+    "LOG_DIR": "./log",
+    "WORKERS": 1,
+    "MEDIAN_MODE": "exact",
+    "CACHE_DIR": None,
+    "CACHE_SIZE": 1024,
+    "FOLLOW_LOG": "",
+    "FOLLOW_INTERVAL": 60,
+    "URL_NORMALIZE": False,
+    "URL_STRIP_PARAMS": "_",
+    "URL_REWRITES": "",
+    "URL_MAX_KEYS": 0,
+    "GZIP_BACKEND": "auto",
+    "MMAP": True,
+    "METRICS_FILE": "",
+    "ERROR_THRESHOLD": 50,
+    "ERROR_SAMPLE_SIZE": 10000,
+    "SAMPLE_RATE": 1,
+    "LOG_INDEX_FILE": "",
+    "LOG_DIRS": "",
+    "LOG_FORMAT": "",
+    "GROUP_BY": "",
+    "TIME_FIELD": "request_time",
+    "EXPORT_DIR": "",
+    "EXPORT_SIZE": 0,
+    "EXPORT_COMPRESS": False
 }
+MEDIAN_EXACT = 'exact'
+MEDIAN_APPROX = 'approx'
+# Перцентили request_time, которые выводятся в отчет рядом с медианой
+PERCENTILES = (90, 95, 99)
+# Типы числовых колонок экспорта не зависят от значений (get_perc может вернуть int 0);
+# остальные колонки (url и измерения GROUP_BY) - строки EXPORT_DICT
+EXPORT_COLUMN_TYPES = {
+    'count': EXPORT_INT,
+    **dict.fromkeys((
+        'time_avg', 'time_max', 'time_sum', 'time_med', *(f'time_p{p}' for p in PERCENTILES),
+        'time_perc', 'count_perc', 'time_perc_ci', 'count_perc_ci',
+    ), EXPORT_FLOAT),
+}
+# Относительная точность квантилей в режиме MEDIAN_MODE=approx
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+SKETCH_MIN_VALUE = 0.001
+SKETCH_MAX_BUCKETS = 1024
+# Сегмент пути или значение параметра, похожее на идентификатор: число, hex-строка с цифрами, uuid
+ID_SEGMENT_COMPILED = re.compile(
+    r'^(?:\d+|(?=[a-f]*\d)[0-9a-f]{8,}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$',
+    re.IGNORECASE,
+)
+ID_PLACEHOLDER = '{id}'
+# Урл, в который попадают все урлы сверх URL_MAX_KEYS
+OTHER_URL = '__other__'
+# Сколько нераспарсенных строк сохранять для диагностики
+ERROR_EXAMPLES_COUNT = 5
+# Версия разбора логов; увеличивается при изменениях, после которых кэш агрегатов устаревает
+PARSER_VERSION = 6
+# Активный (еще не ротированный) лог в LOG_DIR для режима --follow
+ACTIVE_LOG_NAME = 'nginx-access-ui.log'
+LIVE_REPORT_NAME = 'report-live.html'
+CACHE_FILE_EXT = '.pickle'
+CACHE_DIR_NAME = '.cache'
+# Способы распаковки архивов: auto - pigz или gzip, если они установлены, иначе модуль gzip;
+# thread - zlib в отдельном потоке; python - gzip.open в потоке разбора
+GZIP_BACKEND_AUTO = 'auto'
+GZIP_BACKEND_PIGZ = 'pigz'
+GZIP_BACKEND_ZCAT = 'zcat'
+GZIP_BACKEND_THREAD = 'thread'
+GZIP_BACKEND_PYTHON = 'python'
+GZIP_BACKENDS = (GZIP_BACKEND_AUTO, GZIP_BACKEND_PIGZ, GZIP_BACKEND_ZCAT, GZIP_BACKEND_THREAD, GZIP_BACKEND_PYTHON)
+READ_BUFFER_SIZE = 1024 * 1024
+# Количество распакованных блоков, которые поток распаковки может держать впереди разбора
+GZIP_QUEUE_SIZE = 8
+ZLIB_GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Размер блока, по которому при чтении через mmap считаются строки
+MMAP_BLOCK_SIZE = 4 * 1024 * 1024
+# При SAMPLE_RATE < 1 строка попадает в выборку, если ее crc32 меньше SAMPLE_RATE * SAMPLE_HASH_RANGE
+SAMPLE_HASH_RANGE = 2 ** 32
+# Размер блока, которыми через mmap читается выборка несжатого лога
+SAMPLE_BLOCK_SIZE = 256 * 1024
+# Квантиль нормального распределения для 95% доверительного интервала
+SAMPLE_CONFIDENCE_Z = 1.96
+# Индексу LOG_INDEX_FILE нельзя доверять, если директория изменилась меньше чем за столько
+# наносекунд до сканирования: файл, добавленный в тот же квант времени mtime, не изменит mtime
+LOG_INDEX_RACY_NS = 2 * 10 ** 9
+# Сколько директорий LOG_DIRS сканируется одновременно
+LOG_DIRS_LISTING_THREADS = 16
+# Количество строк архива, которое отправляется в один процесс-обработчик
+GZIP_BATCH_SIZE = 50000
 
 
 def get_args() -> optparse.Values:
     args_parser = optparse.OptionParser()
     args_parser.add_option('-c', '--config', dest="config",
                            help="Абсолютный путь к файлу конфигурации", default="")
+    args_parser.add_option('-f', '--force', dest="force", action="store_true", default=False,
+                           help="Пересоздать отчет, даже если он уже существует")
+    args_parser.add_option('--all', dest="all", action="store_true", default=False,
+                           help="Построить отчеты по всем логам, для которых их еще нет")
+    args_parser.add_option('--since', dest="since", default="",
+                           help="Как --all, но только для логов начиная с даты ГГГГ-ММ-ДД")
+    args_parser.add_option('--until', dest="until", default="",
+                           help="Последняя дата ГГГГ-ММ-ДД для --rollup")
+    args_parser.add_option('--rollup', dest="rollup", action="store_true", default=False,
+                           help="Сводный отчет за период --since..--until по агрегатам дней")
+    args_parser.add_option('--follow', dest="follow", action="store_true", default=False,
+                           help="Следить за активным логом и периодически обновлять отчет")
+    args_parser.add_option('--sample', dest="sample", type="float", default=None,
+                           help="Доля строк лога (0..1) для быстрого приблизительного отчета, см. SAMPLE_RATE")
+    args_parser.add_option('--profile', dest="profile", default="",
+                           help="Сохранить профиль запуска cProfile в указанный файл (pstats)")
+    args_parser.add_option('--invalidate-cache', dest="invalidate_cache", action="store_true", default=False,
+                           help="Очистить кэш агрегатов и выйти")
     args, _ = args_parser.parse_args()
     return args
 
@@ -76,43 +252,439 @@ def get_filename_from_path(path: str) -> str:
     return os.path.split(path)[-1]
 
 
-def get_log_files(log_dir: str) -> list[NamedTuple]:
-    result = []
-    for filenames in os.listdir(log_dir):
-        file_date = get_file_date(filenames)
+class Metrics:
+    """
+    Метрики одного запуска: длительности этапов и счетчики (строки, байты, урлы).
+    Передается необязательным параметром metrics в функции обработки. Каждый завершенный
+    этап пишется в лог log-analyzer.metrics записью с JSON, итог можно сохранить
+    для node exporter в формате Prometheus (*.prom) или в JSON (write).
+    """
+    enabled = True
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self.values: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            metrics_logger.info(json.dumps({'stage': name, 'seconds': round(seconds, 6)}))
+
+    def incr(self, name: str, value: float = 1):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        self.values[name] = value
+
+    def record_log_stats(self, log_stats: 'LogStats'):
+        self.incr('lines_read', log_stats.requests_count)
+        self.incr('lines_parsed', log_stats.parsed_count)
+        self.incr('lines_failed', log_stats.requests_count - log_stats.parsed_count)
+        self.set('distinct_urls', len(log_stats.urls))
+
+    def as_dict(self) -> dict[str, Any]:
+        # ru_maxrss в Linux - в килобайтах
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return {'stages': dict(self.stages), **self.values, 'peak_rss_bytes': peak_rss}
+
+    def to_prometheus(self) -> str:
+        data = self.as_dict()
+        lines = ['# TYPE log_analyzer_stage_seconds gauge']
+        lines += [
+            f'log_analyzer_stage_seconds{{stage="{name}"}} {seconds}'
+            for name, seconds in data.pop('stages').items()
+        ]
+        for name, value in data.items():
+            lines += [f'# TYPE log_analyzer_{name} gauge', f'log_analyzer_{name} {value}']
+        lines += ['# TYPE log_analyzer_last_run_timestamp_seconds gauge',
+                  f'log_analyzer_last_run_timestamp_seconds {time.time()}']
+        return '\n'.join(lines) + '\n'
+
+    def emit(self):
+        metrics_logger.info(json.dumps(self.as_dict()))
+
+    def write(self, path: str):
+        """Атомарно сохраняет метрики: *.prom - текстовый формат Prometheus, иначе JSON."""
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.as_dict(), indent=2)
+        # Файл читается node_exporter от другого пользователя, atomic_write оставляет права 0644
+        with atomic_write(path) as f:
+            f.write(content)
+
+
+class NullMetrics(Metrics):
+    """Метрики по умолчанию: ничего не замеряют и не пишут."""
+    enabled = False
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        yield
+
+    def incr(self, name: str, value: float = 1):
+        pass
+
+    def set(self, name: str, value: float):
+        pass
+
+    def record_log_stats(self, log_stats: 'LogStats'):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def scan_log_dir(
+        log_dir: str,
+        known: Optional[dict[str, date]] = None
+) -> Generator[tuple[str, date], None, None]:
+    """
+    Один проход os.scandir по LOG_DIR: имена без LOG_FILE_PREFIX отбрасываются сразу,
+    дата разбирается только у подходящих файлов, которых нет в known (индекс LogIndex).
+    Вместо сообщения на каждый файл с нераспознанной датой пишется одно общее.
+    """
+    skipped = 0
+    with os.scandir(log_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.startswith(LOG_FILE_PREFIX):
+                continue
+            if known and name in known:
+                yield name, known[name]
+            elif file_date := parse_file_date(name):
+                yield name, file_date
+            else:
+                skipped += 1
+
+    if skipped:
+        logger.info(f'Не удается распарсить дату у {skipped} лог файлов в {log_dir}')
+
+
+def get_log_files(
+        log_dir: str,
+        metrics: Metrics = NULL_METRICS,
+        index: Optional['LogIndex'] = None
+) -> list[File]:
+    with metrics.stage('listing'):
         # Берем только логи сервиса ui, только те у которых парсится дата в имени
-        if re.search(SERVICE_NAME_PATTERN, filenames) and file_date:
-            result.append(File((os.path.join(log_dir, filenames)), file_date))
+        files = index.scan(log_dir) if index else dict(scan_log_dir(log_dir))
+        result = [File(os.path.join(log_dir, name), file_date) for name, file_date in files.items()]
 
-    return sorted(result, key=lambda pair: pair.date, reverse=True)  # type: ignore
+    return sorted(result, key=lambda pair: pair.date, reverse=True)
 
 
-def get_file_date(file_path: str) -> Optional[date]:
-    if date := FILE_NAME_COMPILED.match(get_filename_from_path(file_path)):
+def get_last_log_file(
+        log_dir: str,
+        metrics: Metrics = NULL_METRICS,
+        index: Optional['LogIndex'] = None
+) -> Optional[File]:
+    """Самый свежий лог: максимум по дате за один проход, без сортировки всего списка."""
+    with metrics.stage('listing'):
+        files = index.scan(log_dir).items() if index else scan_log_dir(log_dir)
+        latest = max(files, key=lambda pair: pair[1], default=None)
+
+    if latest is None:
+        return None
+    name, file_date = latest
+    return File(os.path.join(log_dir, name), file_date)
+
+
+class LogIndex:
+    """
+    Индекс LOG_DIR в файле LOG_INDEX_FILE: даты уже известных логов и имена построенных отчетов
+    (полные и по выборке называются по-разному, см. get_report_name). Если mtime директории
+    не изменился, она не сканируется вовсе, иначе разбираются только имена новых файлов.
+    Отчеты проверяются на диске только если их нет в индексе; если изменился mtime директории
+    отчетов (например, отчет удалили), отметки перепроверяются.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.log_dir: Optional[str] = None
+        self.dir_mtime_ns: Optional[int] = None
+        self.files: dict[str, date] = {}
+        self.report_dir: Optional[str] = None
+        self.report_dir_mtime_ns: Optional[int] = None
+        self.reported: set[str] = set()
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f'Не удалось прочитать индекс логов {path}: {e}')
+            return
+        self.log_dir = data.get('log_dir')
+        self.dir_mtime_ns = data.get('dir_mtime_ns')
+        self.files = {name: date.fromisoformat(value) for name, value in data.get('files', {}).items()}
+        self.report_dir = data.get('report_dir')
+        self.report_dir_mtime_ns = data.get('report_dir_mtime_ns')
+        self.reported = set(data.get('reported', []))
+
+    @staticmethod
+    def get_stable_mtime_ns(path: str) -> Optional[int]:
+        """mtime директории, если он достаточно старый, чтобы по нему можно было судить об изменениях."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        return mtime_ns if time.time_ns() - mtime_ns > LOG_INDEX_RACY_NS else None
+
+    def scan(self, log_dir: str) -> dict[str, date]:
+        if log_dir != self.log_dir:
+            self.log_dir, self.dir_mtime_ns, self.files = log_dir, None, {}
+        mtime_ns = self.get_stable_mtime_ns(log_dir)
+        if mtime_ns is None or mtime_ns != self.dir_mtime_ns:
+            self.files = dict(scan_log_dir(log_dir, self.files))
+            self.dir_mtime_ns = mtime_ns
+        return self.files
+
+    def get_report_name(self, log: str, sample_rate: float = 1) -> str:
+        """Имя отчета по дате из индекса, без повторного разбора имени файла."""
+        name = get_filename_from_path(log)
+        if name in self.files:
+            return format_report_name(self.files[name], sample_rate)
+        return get_report_name(log, sample_rate)
+
+    def is_reported(self, log: str, report_dir: str, sample_rate: float = 1) -> bool:
+        if report_dir != self.report_dir:
+            self.report_dir, self.reported = report_dir, set()
+        mtime_ns = self.get_stable_mtime_ns(report_dir)
+        if mtime_ns is None or mtime_ns != self.report_dir_mtime_ns:
+            self.reported = {
+                report_name for report_name in self.reported
+                if os.path.exists(os.path.join(report_dir, report_name))
+            }
+            self.report_dir_mtime_ns = mtime_ns
+
+        report_name = self.get_report_name(log, sample_rate)
+        if report_name not in self.reported and os.path.exists(os.path.join(report_dir, report_name)):
+            self.reported.add(report_name)
+        return report_name in self.reported
+
+    def mark_reported(self, log: str, report_dir: str, sample_rate: float = 1):
+        """Отчет только что построен анализатором: изменение mtime директории отчетов уже учтено."""
+        if report_dir != self.report_dir:
+            self.report_dir, self.reported = report_dir, set()
+        self.reported.add(self.get_report_name(log, sample_rate))
+        self.report_dir_mtime_ns = os.stat(report_dir).st_mtime_ns
+
+    def save(self):
+        with atomic_write(self.path) as f:
+            json.dump({
+                'log_dir': self.log_dir,
+                'dir_mtime_ns': self.dir_mtime_ns,
+                'files': {name: file_date.isoformat() for name, file_date in self.files.items()},
+                'report_dir': self.report_dir,
+                'report_dir_mtime_ns': self.report_dir_mtime_ns,
+                'reported': sorted(self.reported),
+            }, f)
+
+
+def get_log_dirs(conf: dict) -> list[str]:
+    """
+    Директории логов: LOG_DIRS - директории или glob-шаблоны (например, /var/log/nginx/*)
+    через запятую или с новой строки; если LOG_DIRS не задан - один LOG_DIR.
+    """
+    patterns = [pattern.strip() for pattern in re.split(r'[,\n]', conf['LOG_DIRS'] or '') if pattern.strip()]
+    if not patterns:
+        return [conf['LOG_DIR']]
+
+    log_dirs: list[str] = []
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern)) if any(char in pattern for char in '*?[') else [pattern]
+        if not paths:
+            logger.warning(f'Нет директорий, подходящих под {pattern}')
+        log_dirs.extend(path for path in paths if os.path.isdir(path) and path not in log_dirs)
+    return log_dirs
+
+
+def get_fleet_log_files(log_dirs: list[str], metrics: Metrics = NULL_METRICS) -> list[FleetDay]:
+    """Логи всех директорий, сгруппированные по дням (FleetDay), свежие первыми. Директории сканируются в потоках."""
+    days: dict[date, list[str]] = defaultdict(list)
+    with metrics.stage('listing'):
+        with ThreadPoolExecutor(max_workers=max(1, min(len(log_dirs), LOG_DIRS_LISTING_THREADS))) as executor:
+            for log_files in executor.map(get_log_files, log_dirs):
+                for log_file in log_files:
+                    days[log_file.date].append(log_file.filename)
+
+    return [FleetDay(days[file_date], file_date) for file_date in sorted(days, reverse=True)]
+
+
+def parse_file_date(filename: str) -> Optional[date]:
+    if match := FILE_NAME_COMPILED.match(filename):
+        value = match.group('date')
         try:
-            return datetime.strptime(date.group('date'), '%Y%m%d').date()
-        except (ValueError, AttributeError):
+            return date(int(value[:4]), int(value[4:6]), int(value[6:]))
+        except ValueError:
             pass
+    return None
+
+
+def get_file_date(file_path: str) -> Optional[date]:
+    if file_date := parse_file_date(get_filename_from_path(file_path)):
+        return file_date
 
     logger.info(f'Не удается распарсить дату лог файла {file_path}')
     return None
 
 
-def get_report_name(filename: str) -> str:
-    date = get_file_date(filename)
-    if not date:
-        return 'report-unknown.html'
-    return f"report-{datetime.strftime(date, '%Y.%m.%d')}.html"
+def get_report_name(filename: str, sample_rate: float = 1) -> str:
+    return format_report_name(get_file_date(filename), sample_rate)
+
+
+def format_report_name(file_date: Optional[date], sample_rate: float = 1) -> str:
+    """Отчет по выборке называется отдельно, чтобы не считаться полным отчетом за день."""
+    suffix = '.sample' if sample_rate < 1 else ''
+    if not file_date:
+        return f'report-unknown{suffix}.html'
+    return f"report-{datetime.strftime(file_date, '%Y.%m.%d')}{suffix}.html"
 
 
 def is_gzip_file(filename: str) -> bool:
     return filename.split('.')[-1] == 'gz'
 
 
-def unpack_file(log: str) -> Generator[str, None, None]:
-    is_archive = is_gzip_file(log)
-    open_fn = gzip.open if is_archive else open
-    with open_fn(log, 'rb') as f:  # type: ignore
+class ThreadedGzipReader(io.RawIOBase):
+    """
+    Распаковка gzip в отдельном потоке: zlib отпускает GIL, поэтому распаковка идет
+    параллельно с разбором строк. Распакованные блоки передаются через ограниченную очередь.
+    Поддерживаются архивы из нескольких gzip-потоков подряд, как и в модуле gzip.
+    """
+
+    def __init__(self, path: str, block_size: int = READ_BUFFER_SIZE):
+        super().__init__()
+        self._queue: queue.Queue = queue.Queue(maxsize=GZIP_QUEUE_SIZE)
+        self._stopped = threading.Event()
+        self._buffer = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._decompress, args=(path, block_size), daemon=True)
+        self._thread.start()
+
+    def _put(self, item: Any) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decompress(self, path: str, block_size: int):
+        try:
+            with open(path, 'rb') as f:
+                decompressor = zlib.decompressobj(ZLIB_GZIP_WBITS)
+                while block := f.read(block_size):
+                    chunks = []
+                    while block:
+                        if decompressor.eof:
+                            decompressor = zlib.decompressobj(ZLIB_GZIP_WBITS)
+                        chunks.append(decompressor.decompress(block))
+                        block = decompressor.unused_data if decompressor.eof else b''
+                    if not self._put(b''.join(chunks)):
+                        return
+                if not decompressor.eof:
+                    raise EOFError(f'Архив {path} обрезан')
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(None)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        while not self._buffer and not self._eof:
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self._buffer = memoryview(item)
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        self._stopped.set()
+        super().close()
+
+
+def get_decompress_command(backend: str) -> Optional[list[str]]:
+    """Команда внешней распаковки в stdout для backend или None, если она не нужна/недоступна."""
+    tools = {
+        GZIP_BACKEND_AUTO: ('pigz', 'gzip'),
+        GZIP_BACKEND_PIGZ: ('pigz',),
+        GZIP_BACKEND_ZCAT: ('gzip',),
+    }.get(backend, ())
+    for tool in tools:
+        if path := shutil.which(tool):
+            return [path, '-dc']
+    if backend in (GZIP_BACKEND_PIGZ, GZIP_BACKEND_ZCAT):
+        logger.warning(f'Утилита {backend} не найдена, используется модуль gzip.')
+    return None
+
+
+@contextmanager
+def open_log(log: str, gzip_backend: str = GZIP_BACKEND_PYTHON) -> Generator[Any, None, None]:
+    """
+    Открывает лог на чтение в байтах с буфером READ_BUFFER_SIZE. Архив распаковывается
+    способом gzip_backend (см. GZIP_BACKENDS). Все способы ведут себя одинаково:
+    пустой файл .gz (например, только что созданный logrotate) читается как пустой лог,
+    а обрезанный или поврежденный архив приводит к EOFError.
+    """
+    if not is_gzip_file(log) or not os.path.getsize(log):
+        with open(log, 'rb', buffering=READ_BUFFER_SIZE) as f:
+            yield f
+        return
+
+    if command := get_decompress_command(gzip_backend):
+        with subprocess.Popen([*command, log], stdout=subprocess.PIPE, bufsize=READ_BUFFER_SIZE) as process:
+            try:
+                yield process.stdout
+            except BaseException:
+                process.kill()
+                raise
+        if process.returncode:
+            raise EOFError(
+                f'Архив {log} обрезан или поврежден: {command[0]} завершился с кодом {process.returncode}'
+            )
+    elif gzip_backend == GZIP_BACKEND_THREAD:
+        with io.BufferedReader(ThreadedGzipReader(log), READ_BUFFER_SIZE) as f:
+            yield f
+    else:
+        with gzip.open(log, 'rb') as f:
+            yield f
+
+
+def count_bytes(lines: Iterable[bytes], metrics: Metrics) -> Generator[bytes, None, None]:
+    size = 0
+    try:
+        for line in lines:
+            size += len(line)
+            yield line
+    finally:
+        metrics.incr('bytes_decompressed', size)
+
+
+def unpack_file(
+        log: str,
+        decode: bool = True,
+        gzip_backend: str = GZIP_BACKEND_PYTHON,
+        metrics: Metrics = NULL_METRICS
+) -> Generator[Any, None, None]:
+    """
+    Построчно читает лог. При decode=False строки отдаются как есть, в байтах,
+    для парсеров, которые работают без декодирования всей строки (pars_log_bytes).
+    """
+    with open_log(log, gzip_backend) as f:
+        if metrics.enabled:
+            f = count_bytes(f, metrics)
+        if not decode:
+            yield from f
+            return
         for line in f:
             yield line.decode()
 
@@ -123,105 +695,1769 @@ def get_perc(total_count: float, count: float) -> float:
     return 100 / total_count * count
 
 
-def get_data_for_render(log_list: list, requests_count: int, report_size: int) -> Optional[list[dict[str, Any]]]:
+class TimeHistogram(Counter):
+    """
+    Точное распределение request_time урла: счетчик значений. nginx пишет $request_time
+    с точностью до миллисекунд, поэтому различных значений немного.
+    """
+
+    def add(self, value: float):
+        self[value] += 1
+
+    def merge(self, other: 'TimeHistogram'):
+        self.update(other)
+
+    def quantile(self, q: float) -> float:
+        """Значение с рангом floor(q * (n - 1)) в отсортированной выборке."""
+        rank = int(q * (self.total() - 1))
+        seen = 0
+        for value in sorted(self):
+            seen += self[value]
+            if seen > rank:
+                return float(value)
+        return 0.0
+
+    def median(self) -> float:
+        """Медиана в том же смысле, что и statistics.median."""
+        count = self.total()
+        values = sorted(self)
+        middle = count // 2
+        seen = 0
+        for i, value in enumerate(values):
+            seen += self[value]
+            if seen > middle:
+                if count % 2 or seen - self[value] < middle:
+                    return float(value)
+                # Четное количество и середина попала на границу двух значений
+                return float(values[i - 1] + value) / 2
+        return 0.0
+
+
+class TimeSketch:
+    """
+    Приближенное распределение request_time с памятью, не зависящей от количества запросов
+    (логарифмические корзины, как в DDSketch). Значение v попадает в корзину
+    ceil(log(v) / log(gamma)), где gamma = (1 + a) / (1 - a), a = SKETCH_ACCURACY.
+    Любой квантиль возвращается с относительной ошибкой не более a относительно точного
+    значения с тем же рангом (см. TimeHistogram.quantile). Для значений от 1 мс до 1000 с
+    это не более ~700 корзин; сверх SKETCH_MAX_BUCKETS сливаются самые младшие корзины,
+    и точность теряется только для самых быстрых запросов.
+    Медиана считается как нижняя медиана: при четном количестве значений она может
+    отличаться от точной больше, чем на a, если два средних значения сильно различаются.
+    """
+    __slots__ = ('buckets', 'zero_count')
+
+    def __init__(self):
+        self.buckets: Counter = Counter()
+        self.zero_count = 0
+
+    def add(self, value: float):
+        if value < SKETCH_MIN_VALUE:
+            self.zero_count += 1
+            return
+        self.buckets[math.ceil(math.log(value) / SKETCH_LOG_GAMMA)] += 1
+        if len(self.buckets) > SKETCH_MAX_BUCKETS:
+            self._collapse()
+
+    def merge(self, other: 'TimeSketch'):
+        self.zero_count += other.zero_count
+        self.buckets.update(other.buckets)
+        while len(self.buckets) > SKETCH_MAX_BUCKETS:
+            self._collapse()
+
+    def _collapse(self):
+        lowest, second = sorted(self.buckets)[:2]
+        self.buckets[second] += self.buckets.pop(lowest)
+
+    def quantile(self, q: float) -> float:
+        rank = int(q * (self.zero_count + self.buckets.total() - 1))
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return float(2 * SKETCH_GAMMA ** key / (SKETCH_GAMMA + 1))
+        return 0.0
+
+    def median(self) -> float:
+        return self.quantile(0.5)
+
+
+class UrlNormalizer:
     """
-    Функция получает на вход список распаршенных логов, отдельно собирает список урлов для подсчета
-    количества (используется collections.Counter) и формирует словарь для расчета требуемых значений
-    вида {'url': [1.2, 1,3, 1.4]}, где значения - списки request_time относящихся к данному урлу.
+    Приводит урл к шаблону маршрута, чтобы группировка шла по ограниченному набору ключей:
+    идентификаторы в сегментах пути и значениях параметров заменяются на {id},
+    параметры из strip_params (например, анти-кэш "_") удаляются, затем по порядку
+    применяются пользовательские замены rewrites (регулярное выражение, замена).
+    """
+
+    def __init__(self, strip_params: Iterable[str] = (), rewrites: Iterable[tuple[Pattern, str]] = ()):
+        self.strip_params = frozenset(strip_params)
+        self.rewrites = list(rewrites)
+
+    def __call__(self, url: str) -> str:
+        path, _, query = url.partition('?')
+        path = '/'.join(
+            ID_PLACEHOLDER if ID_SEGMENT_COMPILED.match(segment) else segment
+            for segment in path.split('/')
+        )
+        if query:
+            params = []
+            for param in query.split('&'):
+                name, eq, value = param.partition('=')
+                if name in self.strip_params:
+                    continue
+                if ID_SEGMENT_COMPILED.match(value):
+                    value = ID_PLACEHOLDER
+                params.append(name + eq + value)
+            query = '&'.join(params)
+        url = f'{path}?{query}' if query else path
+        for pattern, replacement in self.rewrites:
+            url = pattern.sub(replacement, url)
+        return url
+
+
+class LogParseError(Exception):
+    pass
+
+
+class ErrorMonitor:
+    """
+    Следит за долей нераспарсенных строк во время чтения лога. Как только прочитано
+    sample_size строк (статистически значимая выборка), доля ошибок проверяется
+    при каждой проверке check; если она больше threshold процентов, обработка прерывается
+    LogParseError, а не после чтения всего файла. Первые нераспарсенные строки
+    сохраняются и попадают в текст ошибки. Пустой лог при итоговой проверке - тоже ошибка.
+    В кэш агрегатов попадают только примеры строк: порог и размер выборки берутся
+    из текущего конфига (см. save_cached_stats).
+    """
+
+    def __init__(self, threshold: float = 50, sample_size: int = 10000):
+        self.threshold = threshold
+        self.sample_size = sample_size
+        self.examples: list[Any] = []
+
+    def spawn(self) -> 'ErrorMonitor':
+        return ErrorMonitor(self.threshold, self.sample_size)
+
+    @property
+    def needs_examples(self) -> bool:
+        return len(self.examples) < ERROR_EXAMPLES_COUNT
+
+    def add_failed(self, line: Any):
+        if len(self.examples) < ERROR_EXAMPLES_COUNT:
+            self.examples.append(line)
+
+    def add_unmatched(self, data: bytes):
+        """Строки куска файла data, целиком не подошедшего под шаблон строки лога."""
+        lines = data.split(b'\n')
+        if data.endswith(b'\n'):
+            lines.pop()
+        for line in lines[:ERROR_EXAMPLES_COUNT]:
+            self.add_failed(line)
+
+    def merge(self, other: 'ErrorMonitor'):
+        for line in other.examples:
+            self.add_failed(line)
+
+    def is_exceeded(self, requests_count: int, parsed_count: int, final: bool = False) -> bool:
+        """При final=True проверка выполняется и на выборке меньше sample_size (конец файла)."""
+        if not requests_count or requests_count < self.sample_size and not final:
+            return False
+        return get_perc(requests_count, requests_count - parsed_count) > self.threshold
+
+    def check(self, requests_count: int, parsed_count: int, final: bool = False):
+        if final and not requests_count:
+            raise LogParseError('в логе нет ни одной строки')
+        if not self.is_exceeded(requests_count, parsed_count, final):
+            return
+        failed_perc = get_perc(requests_count, requests_count - parsed_count)
+        examples = ''.join(f'\n  {line!r}' for line in self.examples)
+        raise LogParseError(
+            f'не удалось распарсить {failed_perc:.1f}% из {requests_count} прочитанных строк '
+            f'(допустимо {self.threshold}%). Примеры строк:{examples}'
+        )
+
+
+class LogStats:
+    """
+    Агрегат по всему логу, собираемый за один проход: память зависит от количества
+    различных урлов, а не от количества строк.
+    Хранение колоночное: урлу присваивается номер, а количество, сумма и максимум
+    request_time лежат в плотных массивах array по этому номеру (8 байт на значение
+    вместо отдельного python-объекта). Распределение request_time каждого урла -
+    TimeHistogram или TimeSketch, в зависимости от MEDIAN_MODE.
+    Перед группировкой урл можно привести к шаблону (normalizer), а количество различных
+    урлов ограничить max_keys: все новые урлы сверх лимита попадают в OTHER_URL.
+    error_monitor прерывает разбор, если доля нераспарсенных строк слишком велика.
+    При sample_rate < 1 агрегат строится по выборке строк: счетчики хранятся как есть
+    и масштабируются при подготовке отчета на фактически прочитанную долю лога
+    (sampled_fraction), а суммы квадратов request_time нужны для доверительных интервалов.
+    Если заданы измерения group_by, строки группируются по урлу вместе со значениями
+    измерений: ключ агрегата - урл и значения через GROUP_SEPARATOR.
+    """
+
+    def __init__(
+            self,
+            median_mode: str = MEDIAN_EXACT,
+            normalizer: Optional[UrlNormalizer] = None,
+            max_keys: int = 0,
+            error_monitor: Optional[ErrorMonitor] = None,
+            sample_rate: float = 1,
+            group_by: tuple[str, ...] = ()
+    ):
+        self.median_mode = median_mode
+        self.normalizer = normalizer
+        self.max_keys = max_keys
+        self.error_monitor = error_monitor
+        self.sample_rate = sample_rate
+        self.group_by = group_by
+        self.urls: dict[str, int] = {}
+        self.counts = array('q')
+        self.time_sums = array('d')
+        self.time_maxes = array('d')
+        self.time_sq_sums = array('d')
+        self.times: list[Any] = []
+        self.requests_count = 0
+        self.parsed_count = 0
+        self.total_request_time = 0.0
+        self.total_sq_request_time = 0.0
+        # Байты лога, попавшие в выборку, и размер всех выбиравшихся логов
+        self.sampled_bytes = 0.0
+        self.total_bytes = 0
+
+    @property
+    def is_sampled(self) -> bool:
+        return self.sample_rate < 1
+
+    @property
+    def sampled_fraction(self) -> float:
+        """
+        Доля лога, по которой построен агрегат. Выборка блоками читает целые блоки,
+        поэтому доля отличается от sample_rate, особенно у небольших файлов.
+        """
+        if self.total_bytes:
+            return self.sampled_bytes / self.total_bytes
+        return self.sample_rate
+
+    def add_sampled_bytes(self, sampled: float, total: int):
+        self.sampled_bytes += sampled
+        self.total_bytes += total
+
+    def spawn(self) -> 'LogStats':
+        """Пустой агрегат с теми же настройками, например для процесса-обработчика."""
+        error_monitor = self.error_monitor.spawn() if self.error_monitor else None
+        return LogStats(
+            self.median_mode, self.normalizer, self.max_keys, error_monitor, self.sample_rate, self.group_by
+        )
+
+    def _get_url_id(self, url: str) -> int:
+        if (url_id := self.urls.get(url)) is None:
+            if self.max_keys and len(self.urls) >= self.max_keys and url != OTHER_URL:
+                return self._get_url_id(OTHER_URL)
+            url_id = self.urls[url] = len(self.counts)
+            self.counts.append(0)
+            self.time_sums.append(0.0)
+            self.time_maxes.append(0.0)
+            self.time_sq_sums.append(0.0)
+            self.times.append(TimeSketch() if self.median_mode == MEDIAN_APPROX else TimeHistogram())
+        return url_id
+
+    def add(self, url: str, request_time: Any, group: str = ''):
+        request_time = float(request_time)
+        self.parsed_count += 1
+        self.total_request_time += request_time
+        if self.normalizer:
+            url = self.normalizer(url)
+        if group:
+            url = f'{url}{GROUP_SEPARATOR}{group}'
+        url_id = self._get_url_id(url)
+        self.counts[url_id] += 1
+        self.time_sums[url_id] += request_time
+        if request_time > self.time_maxes[url_id]:
+            self.time_maxes[url_id] = request_time
+        self.times[url_id].add(request_time)
+        if self.sample_rate < 1:
+            self.time_sq_sums[url_id] += request_time * request_time
+            self.total_sq_request_time += request_time * request_time
+
+    def merge(self, other: 'LogStats'):
+        self.requests_count += other.requests_count
+        self.parsed_count += other.parsed_count
+        self.total_request_time += other.total_request_time
+        self.total_sq_request_time += other.total_sq_request_time
+        self.add_sampled_bytes(other.sampled_bytes, other.total_bytes)
+        for url, other_id in other.urls.items():
+            url_id = self._get_url_id(url)
+            self.counts[url_id] += other.counts[other_id]
+            self.time_sums[url_id] += other.time_sums[other_id]
+            self.time_sq_sums[url_id] += other.time_sq_sums[other_id]
+            self.time_maxes[url_id] = max(self.time_maxes[url_id], other.time_maxes[other_id])
+            self.times[url_id].merge(other.times[other_id])
+        if self.error_monitor and other.error_monitor:
+            self.error_monitor.merge(other.error_monitor)
+
+    def check_errors(self, final: bool = False):
+        if self.error_monitor:
+            self.error_monitor.check(self.requests_count, self.parsed_count, final)
+
+
+def get_data_for_render(
+        log_stats: LogStats,
+        report_size: int,
+        metrics: Metrics = NULL_METRICS
+) -> Optional[list[dict[str, Any]]]:
+    """
+    Функция получает на вход агрегат лога, собранный get_log_data, и формирует отчет в два этапа:
+    сначала по колонке time_sums выбираются report_size урлов с наибольшим time_sum (heapq.nlargest,
+    без сортировки всех урлов), затем только для них считаются медиана, перцентили и доли.
     На выходе формируется результирующий список отсортированный по time_sum и обрезанный по report_size.
 
-    :param log_list: список распаршенных логов
-    :param requests_count: общее колличество записей в логе
+    :param log_stats: агрегированные данные лога
     :param report_size: количество строк для рапорта из конфига
+    :param metrics: метрики запуска
     :return: список результатов для генерации таблицы
     """
-    urls_data: dict[str, Any] = {}
-    url_list: list[str] = []
-    total_request_time = 0.0
-    for url, request_time in log_list:
-        url_list.append(url)
-        request_time = float(request_time)
-        total_request_time += request_time
-        if request_time_list := urls_data.get(url):
-            request_time_list.append(request_time)
-            urls_data[url] = request_time_list
-        else:
-            urls_data[url] = [request_time]
+    with metrics.stage('render'):
+        return _get_data_for_render(log_stats, report_size)
+
+
+def get_count_perc_ci(requests_count: int, count: int) -> float:
+    """
+    Полуширина 95% доверительного интервала count_perc (в процентных пунктах)
+    для доли строк урла в выборке, по нормальному приближению (интервал Вальда).
+    """
+    if requests_count < 2:
+        return 0.0
+    share = count / requests_count
+    return SAMPLE_CONFIDENCE_Z * math.sqrt(share * (1 - share) / requests_count) * 100
 
-    urls_count = Counter(url_list)
 
+def get_time_perc_ci(log_stats: LogStats, url_id: int) -> float:
+    """
+    Полуширина 95% доверительного интервала time_perc (в процентных пунктах).
+    time_perc - отношение сумм R = sum(y) / sum(x), где x - request_time строки,
+    y = x для строк урла и 0 для остальных. Дисперсия отношения по дельта-методу:
+    Var(R) = n / (n - 1) * sum((y - R * x) ** 2) / sum(x) ** 2, а сумма квадратов
+    остатков выражается через суммы квадратов request_time урла и всего лога.
+    Интервалы считаются для независимого отбора строк; при чтении блоками через mmap
+    строки одного блока коррелированы, и реальная погрешность может быть больше.
+    """
+    n, total = log_stats.parsed_count, log_stats.total_request_time
+    if n < 2 or not total:
+        return 0.0
+    share = log_stats.time_sums[url_id] / total
+    residuals = log_stats.time_sq_sums[url_id] * (1 - 2 * share) + share ** 2 * log_stats.total_sq_request_time
+    return SAMPLE_CONFIDENCE_Z * math.sqrt(max(residuals, 0.0) * n / (n - 1)) / total * 100
+
+
+def _get_data_for_render(log_stats: LogStats, report_size: int) -> list[dict[str, Any]]:
     result = []
-    for url in urls_count.keys():
-        request_time_list = urls_data[url]
-        count = urls_count[url]
-        time_sum = sum(request_time_list)
+    counts, time_sums = log_stats.counts, log_stats.time_sums
+    # nlargest эквивалентен sorted(..., reverse=True)[:n], порядок при равных time_sum сохраняется
+    top_urls = heapq.nlargest(int(report_size), log_stats.urls.items(), key=lambda item: time_sums[item[1]])
+    # Агрегат по выборке: количество и сумма времени пересчитываются на весь лог
+    scale = 1 / log_stats.sampled_fraction
+    for url, url_id in top_urls:
+        count = counts[url_id]
+        time_sum = time_sums[url_id]
+        times = log_stats.times[url_id]
+        if log_stats.group_by:
+            url, *groups = url.split(GROUP_SEPARATOR)
         url_data: dict = {
-            "count": count,
-            "time_avg": statistics.fmean(request_time_list),
-            "time_max": max(request_time_list),
-            "time_sum": time_sum,
+            "count": round(count * scale),
+            "time_avg": time_sum / count,
+            "time_max": log_stats.time_maxes[url_id],
+            "time_sum": time_sum * scale,
             "url": url,
-            "time_med": statistics.median(request_time_list),
-            "time_perc": get_perc(total_request_time, time_sum),
-            "count_perc": get_perc(requests_count, count)
+            "time_med": times.median(),
+            **{f"time_p{p}": times.quantile(p / 100) for p in PERCENTILES},
+            "time_perc": get_perc(log_stats.total_request_time, time_sum),
+            "count_perc": get_perc(log_stats.requests_count, count),
         }
+        if log_stats.group_by:
+            # У OTHER_URL значений измерений нет
+            url_data.update(zip_longest(log_stats.group_by, groups, fillvalue=''))
+        if log_stats.is_sampled:
+            url_data["time_perc_ci"] = get_time_perc_ci(log_stats, url_id)
+            url_data["count_perc_ci"] = get_count_perc_ci(log_stats.requests_count, count)
         result.append(url_data)
 
-    return sorted(result, key=lambda d: d['time_sum'], reverse=True)[:int(report_size)]  # type: ignore
+    return result
+
+
+@lru_cache(maxsize=None)
+def load_report_template(path: str = REPORT_TEMPLATE_PATH) -> tuple[str, str]:
+    """Шаблон отчета читается один раз за процесс и делится на части до и после данных."""
+    with open(path, 'r') as f:
+        head, _, tail = f.read().partition(REPORT_TEMPLATE_PLACEHOLDER)
+    return head, tail
+
 
+def to_json(value: Any) -> str:
+    # Экранирование "<" не дает урлу вида "</script>" закрыть тег со встроенными данными
+    return json.dumps(value, ensure_ascii=False).replace('<', '\\u003c')
 
-def create_report(report_name: str, data: list, report_dir: str):
-    with open('report.html', 'r') as f:
-        src = Template(f.read())
-        result = src.safe_substitute(table_json=data)
 
-    with open(TMP_REPORT_PATH, 'w') as f:
-        f.write(result)
+def write_report_data(f, data: list[dict[str, Any]]):
+    """
+    Пишет данные отчета в колоночном виде: {"поле": [значения по строкам], ...}.
+    Имена полей не повторяются в каждой строке, дробные значения округляются
+    до REPORT_FLOAT_PRECISION знаков. Каждая колонка сериализуется и пишется отдельно.
+    """
+    columns = list(data[0]) if data else []
+    f.write('{')
+    for i, column in enumerate(columns):
+        values = [row[column] for row in data]
+        if any(isinstance(value, float) for value in values):
+            values = [round(value, REPORT_FLOAT_PRECISION) for value in values]
+        f.write(f'{"," if i else ""}{to_json(column)}:{to_json(values)}')
+    f.write('}')
+
+
+def get_report_data_name(report_name: str) -> str:
+    return f'{os.path.splitext(report_name)[0]}{REPORT_DATA_EXT}'
+
+
+@contextmanager
+def atomic_replace(path: str) -> Generator[int, None, None]:
+    """
+    Файл пишется во временный файл в той же директории (отдается дескриптор)
+    и атомарно переименовывается, поэтому недописанный файл никогда не окажется
+    на месте готового, а параллельные записи разных файлов не мешают друг другу.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.tmp')
+    try:
+        yield fd
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def atomic_write(path: str) -> Generator[TextIO, None, None]:
+    """Атомарная запись текстового файла в utf-8, см. atomic_replace."""
+    with atomic_replace(path) as fd, os.fdopen(fd, 'w', encoding='utf-8') as f:
+        yield f
 
-    shutil.move(TMP_REPORT_PATH, os.path.join(report_dir, report_name))
+
+@contextmanager
+def atomic_write_bytes(path: str) -> Generator[BinaryIO, None, None]:
+    """Атомарная запись двоичного файла, см. atomic_replace."""
+    with atomic_replace(path) as fd, os.fdopen(fd, 'wb') as f:
+        yield f
+
+
+def create_report(report_name: str, data: list, report_dir: str, metrics: Metrics = NULL_METRICS):
+    """
+    Данные пишутся в отдельный файл рядом с отчетом, страница загружает их после открытия
+    и показывает постранично, отрисовывая только видимые строки. Файл данных пишется
+    первым: по наличию html отчета определяется, что лог уже обработан.
+    """
+    with metrics.stage('report'):
+        head, tail = load_report_template()
+        data_name = get_report_data_name(report_name)
+        with atomic_write(os.path.join(report_dir, data_name)) as f:
+            f.write(f'{REPORT_DATA_VARIABLE} = ')
+            write_report_data(f, data)
+            f.write(';\n')
+        with atomic_write(os.path.join(report_dir, report_name)) as f:
+            f.write(f'{head}{to_json(data_name)}{tail}')
+
+
+def get_export_name(report_name: str) -> str:
+    return f'{os.path.splitext(report_name)[0]}{EXPORT_FILE_EXT}'
+
+
+def to_little_endian(values: array) -> bytes:
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_export_column(values: list, column_type: bytes) -> bytes:
+    """Данные колонки типа column_type: int64, float64 или строки со словарем."""
+    if column_type == EXPORT_INT:
+        return to_little_endian(array('q', values))
+    if column_type == EXPORT_FLOAT:
+        return to_little_endian(array('d', values))
+
+    dictionary: dict[str, int] = {}
+    indices = array('I', (dictionary.setdefault(str(value), len(dictionary)) for value in values))
+    encoded = [value.encode() for value in dictionary]
+    offsets = array('Q', [0])
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    indices_data = to_little_endian(indices)
+    return b''.join((
+        struct.pack('<Q', len(encoded)),
+        to_little_endian(offsets),
+        indices_data,
+        bytes(-len(indices_data) % EXPORT_ALIGN),
+        *encoded,
+    ))
+
+
+def write_export(path: str, data: list[dict[str, Any]], compress: bool = False):
+    """
+    Колоночный экспорт агрегатов для внешних инструментов (дашборды, алерты):
+    заголовок EXPORT_HEADER, каталог колонок EXPORT_COLUMN и данные колонок,
+    выровненные по EXPORT_ALIGN. Числа хранятся массивами int64/float64 (little-endian)
+    без округления, строки (урл и измерения GROUP_BY) - словарем и номерами значений.
+    Без сжатия файл читается через mmap без разбора и копирования (ExportReader);
+    при compress колонки сжимаются zlib и распаковываются при чтении.
+    """
+    columns = list(data[0]) if data else []
+    segments = []
+    for column in columns:
+        if len(column.encode()) > EXPORT_NAME_SIZE:
+            raise ValueError(f'Слишком длинное имя колонки экспорта {column}')
+        column_type = EXPORT_COLUMN_TYPES.get(column, EXPORT_DICT)
+        raw = encode_export_column([row[column] for row in data], column_type)
+        stored = zlib.compress(raw) if compress else raw
+        segments.append((column, column_type, stored, len(raw)))
+
+    offset = EXPORT_HEADER.size + EXPORT_COLUMN.size * len(segments)
+    directory = []
+    for column, column_type, stored, raw_size in segments:
+        offset += -offset % EXPORT_ALIGN
+        directory.append(EXPORT_COLUMN.pack(
+            column.encode(), column_type, EXPORT_CODEC_ZLIB if compress else EXPORT_CODEC_RAW,
+            offset, len(stored), raw_size,
+        ))
+        offset += len(stored)
+
+    with atomic_write_bytes(path) as f:
+        f.write(EXPORT_HEADER.pack(EXPORT_MAGIC, EXPORT_VERSION, len(segments), len(data)))
+        f.writelines(directory)
+        for _, _, stored, _ in segments:
+            f.write(bytes(-f.tell() % EXPORT_ALIGN))
+            f.write(stored)
+
+
+class ExportReader:
+    """
+    Чтение файла write_export через mmap. Разбираются только заголовок и каталог колонок;
+    числовая колонка без сжатия возвращается как memoryview прямо на отображение файла,
+    поэтому загрузка даже большого числа файлов не зависит от количества строк.
+    Значения колонок действительны, пока файл открыт.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f'Пустой файл экспорта {path}')
+        magic, version, columns_count, self.rows_count = EXPORT_HEADER.unpack_from(self._mm)
+        if magic != EXPORT_MAGIC or version != EXPORT_VERSION:
+            self.close()
+            raise ValueError(f'Неизвестный формат файла экспорта {path}')
+        self.columns: dict[str, tuple] = {}
+        for i in range(columns_count):
+            name, *column = EXPORT_COLUMN.unpack_from(self._mm, EXPORT_HEADER.size + EXPORT_COLUMN.size * i)
+            self.columns[name.rstrip(b'\0').decode()] = tuple(column)
+
+    def __enter__(self) -> 'ExportReader':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        try:
+            self._mm.close()
+        except BufferError:
+            # Снаружи остались memoryview на колонки; отображение закроется вместе с ними
+            pass
+        self._file.close()
+
+    def _get_segment(self, name: str) -> memoryview:
+        _, codec, offset, size, _ = self.columns[name]
+        segment = memoryview(self._mm)[offset:offset + size]
+        if codec == EXPORT_CODEC_ZLIB:
+            segment = memoryview(zlib.decompress(segment))
+        return segment
+
+    @staticmethod
+    def _cast(segment: memoryview, typecode: str) -> Any:
+        if sys.byteorder == 'little':
+            return segment.cast(cast(Any, typecode))
+        values = array(typecode, segment)
+        values.byteswap()
+        return values
+
+    def get_dictionary(self, name: str) -> tuple[Any, list[str]]:
+        """Номера значений по строкам и словарь строковой колонки."""
+        segment = self._get_segment(name)
+        size = struct.unpack_from('<Q', segment)[0]
+        offsets_end = 8 + 8 * (size + 1)
+        offsets = self._cast(segment[8:offsets_end], 'Q')
+        indices_end = offsets_end + 4 * self.rows_count
+        indices = self._cast(segment[offsets_end:indices_end], 'I')
+        blob = segment[indices_end + -indices_end % EXPORT_ALIGN:]
+        dictionary = [bytes(blob[offsets[i]:offsets[i + 1]]).decode() for i in range(size)]
+        return indices, dictionary
+
+    def __getitem__(self, name: str) -> Any:
+        column_type = self.columns[name][0]
+        if column_type == EXPORT_DICT:
+            indices, dictionary = self.get_dictionary(name)
+            return [dictionary[index] for index in indices]
+        return self._cast(self._get_segment(name), column_type.decode())
+
+    def to_rows(self) -> list[dict[str, Any]]:
+        columns = {name: list(self[name]) for name in self.columns}
+        return [{name: values[i] for name, values in columns.items()} for i in range(self.rows_count)]
 
 
 def pars_log(log_file: str) -> list[tuple[Any]]:
     return LOG_COMPILED.findall(log_file)
 
 
-def get_log_data(log: str, parser: Callable) -> tuple[list[tuple[Any]], int]:
-    results = []
-    requests_count = 0
-    for log in unpack_file(log):
-        data = parser(log)
-        requests_count += 1
-        results += data
+def pars_log_fields(line: str) -> list[tuple[str, str]]:
+    """
+    Разбор строки по позициям полей log_format без регулярного выражения с возвратами:
+    $request - первое поле в кавычках сразу после [$time_local], $request_time - последнее поле строки.
+    Урл - все, что в $request находится между методом и протоколом.
+    Возвращает список из одного кортежа (url, request_time) или пустой список,
+    чтобы быть взаимозаменяемым с pars_log.
+    """
+    request_start = line.find('] "')
+    if request_start == -1:
+        return []
+    request_start += 3
+    request_end = line.find('"', request_start)
+    if request_end == -1:
+        return []
+    request = line[request_start:request_end].split(' ')
+    if len(request) < 3:
+        return []
+    request_time = line.rstrip('\r\n').rpartition(' ')[2]
+    if not request_time:
+        return []
+    return [(' '.join(request[1:-1]), request_time)]
+
+
+def pars_log_bytes(line: bytes) -> list[tuple[str, float]]:
+    """
+    Разбор сырой строки байтовым регулярным выражением. Декодируется только найденный урл.
+    Урл с некорректным UTF-8 и нечисловое последнее поле (например, у лога в формате combined,
+    где нет $request_time) считаются ошибкой разбора строки, а не прерывают обработку всего файла.
+    """
+    if not (match := LOG_BYTES_COMPILED.match(line)):
+        return []
+    try:
+        url = match.group('url').decode()
+    except UnicodeDecodeError:
+        return []
+    if (request_time := parse_time_value(match.group('request_time'))) is None:
+        return []
+    return [(url, request_time)]
+
+
+def parse_time_value(value: bytes) -> Optional[float]:
+    """
+    Значение времени из лога. У $upstream_response_time при нескольких обращениях к upstream
+    значения перечислены через ", " или " : " и суммируются; "-" (ответа upstream не было)
+    считается ошибкой разбора строки.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return sum(float(part) for part in re.split(rb'[,:]', value.replace(b' ', b'')))
+        except ValueError:
+            return None
+
+
+class LogFormatParser:
+    """
+    Разбор строк по nginx log_format (LOG_FORMAT). Формат один раз компилируется
+    в байтовое регулярное выражение pattern, в котором именованные группы есть только
+    у нужных полей: урла, поля времени time_field и переменных измерений group_by.
+    Переменная формата, за которой идет литерал, разбирается как [^<первый символ литерала>\n]*,
+    без возвратов; $request делится на метод, урл и протокол.
+    Шаблон привязан к началу и концу строки, как LOG_BYTES_COMPILED, поэтому подходит и для
+    отдельной строки, и для finditer по mmap. Экземпляр вызывается как pars_log_bytes,
+    но при group_by возвращает (url, time, значения измерений через GROUP_SEPARATOR).
+    """
+
+    def __init__(self, log_format: str, group_by: tuple[str, ...] = (), time_field: str = 'request_time'):
+        self.log_format = log_format
+        self.group_by = group_by
+        self.time_field = time_field
+        variables = [name or braced for braced, name in LOG_FORMAT_VARIABLE_COMPILED.findall(log_format)]
+        self.url_variable = next((name for name in LOG_FORMAT_URL_VARIABLES if name in variables), None)
+        if not self.url_variable:
+            raise ValueError(f'в LOG_FORMAT нет ни одной из переменных {", ".join(LOG_FORMAT_URL_VARIABLES)}')
+        sources = [self.get_dimension_source(name, variables) for name in group_by]
+        self.dimension_variables = tuple(variable for variable, _ in sources)
+        self.dimension_groups = tuple(group for _, group in sources)
+        for name in (time_field, *self.dimension_variables):
+            if name not in variables:
+                raise ValueError(f'в LOG_FORMAT нет переменной ${name}')
+        try:
+            self.pattern = re.compile(self.compile(log_format), re.MULTILINE)
+        except re.error as e:
+            raise ValueError(f'не удалось разобрать LOG_FORMAT: {e}') from e
+        for name, group in ((time_field, time_field), *zip(group_by, self.dimension_groups)):
+            if group not in self.pattern.groupindex:
+                raise ValueError(f'значение {name} нельзя выделить из LOG_FORMAT')
+
+    @staticmethod
+    def get_dimension_source(name: str, variables: list[str]) -> tuple[str, str]:
+        """
+        Переменная формата и группа шаблона, из которых берется значение измерения name:
+        method - из $request_method, если он есть в формате, иначе из первого слова $request.
+        """
+        if name == 'method' and 'request_method' in variables:
+            return 'request_method', 'request_method'
+        if name in GROUP_BY_DERIVED:
+            variable = GROUP_BY_DERIVED[name]
+            return variable, 'method' if variable == 'request' else variable
+        return name, name
+
+    def compile(self, log_format: str) -> bytes:
+        needed = {self.time_field, *self.dimension_variables}
+        groups: set[str] = set()
+
+        def group(name: str, value: bytes) -> bytes:
+            # именованная группа только у первого вхождения переменной, повторы разбираются без нее
+            if name in groups:
+                return value
+            groups.add(name)
+            return b'(?P<%s>%s)' % (name.encode(), value)
+
+        parts = LOG_FORMAT_VARIABLE_COMPILED.split(log_format)
+        # split с двумя группами: литерал, имя в ${}, имя, литерал, ...
+        literals = parts[::3]
+        names = [braced or name for braced, name in zip(parts[1::3], parts[2::3])]
+        pattern = [b'^', re.escape(literals[0].encode())]
+        for name, literal in zip(names, literals[1:]):
+            stop = re.escape(literal[:1].encode()) if literal else b''
+            value = b'[^%s\n]*' % stop if stop else (b'[^\r\n]*' if name == names[-1] else b'[^\n]*?')
+            if name == 'request':
+                method = b'[^ %s\n]*' % stop
+                if 'method' in self.dimension_groups:
+                    method = group('method', method)
+                url = group('url', value) if self.url_variable == 'request' else value
+                value = b'%s %s [^ %s\n]*' % (method, url, stop)
+            elif name == self.url_variable:
+                value = group('url', value)
+            elif name in needed:
+                value = group(name, value)
+            pattern.append(value)
+            pattern.append(re.escape(literal.encode()))
+        pattern.append(b'\r?$')
+        return b''.join(pattern)
+
+    def get_dimension(self, match: Any, name: str, group: str) -> str:
+        value: bytes = match.group(group)
+        if name == 'status_class':
+            return f'{value[:1].decode()}xx'
+        return value.decode(errors='replace')
 
-    return results, requests_count
+    def get_records(self, match: Any) -> list[tuple]:
+        try:
+            url = match.group('url').decode()
+        except UnicodeDecodeError:
+            return []
+        if (request_time := parse_time_value(match.group(self.time_field))) is None:
+            return []
+        if not self.group_by:
+            return [(url, request_time)]
+        dimensions = (self.get_dimension(match, name, group) for name, group in zip(self.group_by, self.dimension_groups))
+        return [(url, request_time, GROUP_SEPARATOR.join(dimensions))]
+
+    def __call__(self, line: bytes) -> list[tuple]:
+        if not (match := self.pattern.match(line)):
+            return []
+        return self.get_records(match)
+
+
+def sample_lines(lines: Iterable[Any], sample_rate: float) -> Generator[Any, None, None]:
+    """
+    Детерминированная выборка по хэшу строки: одна и та же строка всегда либо попадает
+    в выборку, либо нет, поэтому отчеты по выборке воспроизводимы, а выборка
+    не зависит от урла и не смещает доли урлов.
+    """
+    threshold = int(sample_rate * SAMPLE_HASH_RANGE)
+    for line in lines:
+        if zlib.crc32(line if isinstance(line, bytes) else line.encode()) < threshold:
+            yield line
+
+
+def aggregate_lines(lines: Iterable[Any], parser: Callable, log_stats: Optional[LogStats] = None) -> LogStats:
+    log_stats = log_stats or LogStats()
+    monitor = log_stats.error_monitor
+    if log_stats.is_sampled:
+        lines = sample_lines(lines, log_stats.sample_rate)
+    for line in lines:
+        log_stats.requests_count += 1
+        records = parser(line)
+        for record in records:
+            log_stats.add(*record)
+        if monitor:
+            if not records:
+                monitor.add_failed(line)
+            if log_stats.requests_count % monitor.sample_size == 0:
+                log_stats.check_errors()
+
+    return log_stats
+
+
+def get_file_chunks(log: str, chunks_count: int) -> list[tuple[int, int]]:
+    """
+    Делит несжатый файл на диапазоны байт [start, end), границы которых выровнены
+    по началу строки.
+    """
+    size = os.path.getsize(log)
+    bounds = [0]
+    with open(log, 'rb') as f:
+        for i in range(1, chunks_count):
+            f.seek(max(size * i // chunks_count, bounds[-1]))
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def pars_log_chunk(
+        log: str,
+        start: int,
+        end: int,
+        parser: Callable,
+        decode: bool = True,
+        log_stats: Optional[LogStats] = None
+) -> LogStats:
+    def read_chunk() -> Generator[Any, None, None]:
+        position = start
+        with open(log, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                if position >= end:
+                    break
+                position += len(line)
+                yield line.decode() if decode else line
+
+    return aggregate_lines(read_chunk(), parser, log_stats)
+
+
+def pars_log_batch(
+        lines: list[bytes],
+        parser: Callable,
+        decode: bool = True,
+        log_stats: Optional[LogStats] = None
+) -> LogStats:
+    return aggregate_lines((line.decode() for line in lines) if decode else lines, parser, log_stats)
+
+
+def get_mmap_blocks(mm: Any, start: int, end: int, block_size: int) -> Generator[tuple[int, int], None, None]:
+    """Диапазоны [start, end) отображения, выровненные по концу строки."""
+    while start < end:
+        block_end = mm.find(b'\n', min(start + block_size, end) - 1, end)
+        block_end = end if block_end == -1 else block_end + 1
+        yield start, block_end
+        start = block_end
+
+
+def get_line_start(mm: Any, position: int) -> int:
+    """Начало первой строки, которая начинается не раньше position."""
+    if position <= 0:
+        return 0
+    line_end = mm.find(b'\n', position - 1)
+    return len(mm) if line_end == -1 else line_end + 1
+
+
+def get_sampled_blocks(mm: Any, start: int, end: int, sample_rate: float) -> Generator[tuple[int, int], None, None]:
+    """
+    Выборка блоков диапазона [start, end): файл делится на блоки по SAMPLE_BLOCK_SIZE
+    байт (строка относится к блоку, в котором она начинается), и читается равномерно
+    распределенная по файлу доля sample_rate блоков. Остальные блоки не читаются вовсе.
+    Номера блоков считаются от начала файла, поэтому обработчики частей файла выбирают
+    те же блоки, что и чтение целиком.
+    """
+    for index in range(start // SAMPLE_BLOCK_SIZE, (end - 1) // SAMPLE_BLOCK_SIZE + 1):
+        if math.ceil((index + 1) * sample_rate) == math.ceil(index * sample_rate):
+            continue
+        block_start = max(start, get_line_start(mm, index * SAMPLE_BLOCK_SIZE))
+        block_end = min(end, get_line_start(mm, (index + 1) * SAMPLE_BLOCK_SIZE))
+        if block_start < block_end:
+            yield block_start, block_end
+
+
+def pars_log_mmap(
+        log: str,
+        start: int = 0,
+        end: Optional[int] = None,
+        log_stats: Optional[LogStats] = None,
+        parser: Optional[LogFormatParser] = None
+) -> LogStats:
+    """
+    Разбор несжатого лога через mmap: LOG_BYTES_COMPILED.finditer (или parser.pattern, если
+    задан LOG_FORMAT) идет прямо по отображенному файлу, без построчного чтения и копирования строк;
+    декодируются только нужные поля.
+    Диапазон байт [start, end) позволяет процессам-обработчикам отображать один и тот же файл
+    и разбирать каждый свою часть (границы должны быть выровнены по строкам, см. get_file_chunks).
+    Строки считаются поблочно; результат совпадает с get_log_data(..., pars_log_bytes, decode=False).
+    При выборке (sample_rate < 1) читаются только блоки get_sampled_blocks.
+    """
+    log_stats = log_stats or LogStats()
+    monitor = log_stats.error_monitor
+    pattern = parser.pattern if parser else LOG_BYTES_COMPILED
+    with open(log, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return log_stats
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = len(mm) if end is None else end
+            if log_stats.is_sampled:
+                blocks = get_sampled_blocks(mm, start, end, log_stats.sample_rate)
+                log_stats.add_sampled_bytes(0, end - start)
+            else:
+                blocks = get_mmap_blocks(mm, start, end, MMAP_BLOCK_SIZE)
+            for block_start, block_end in blocks:
+                if log_stats.is_sampled:
+                    log_stats.add_sampled_bytes(block_end - block_start, 0)
+                log_stats.requests_count += mm[block_start:block_end].count(b'\n')
+                if mm[block_end - 1] != ord('\n'):
+                    # Последняя строка файла без перевода строки
+                    log_stats.requests_count += 1
+                # Начало строки после предыдущего совпадения: если следующее совпадение начинается
+                # дальше, строки между ними не подошли под шаблон и попадают в примеры ошибок
+                line_start = block_start
+                if parser:
+                    for match in pattern.finditer(mm, block_start, block_end):
+                        if match.start() != line_start and monitor and monitor.needs_examples:
+                            monitor.add_unmatched(mm[line_start:match.start()])
+                        line_start = match.end() + 1
+                        if records := parser.get_records(match):
+                            log_stats.add(*records[0])
+                        elif monitor:
+                            monitor.add_failed(match.group(0))
+                else:
+                    for match in LOG_BYTES_COMPILED.finditer(mm, block_start, block_end):
+                        if match.start() != line_start and monitor and monitor.needs_examples:
+                            monitor.add_unmatched(mm[line_start:match.start()])
+                        line_start = match.end() + 1
+                        try:
+                            url = match.group('url').decode()
+                        except UnicodeDecodeError:
+                            url = None
+                        request_time = parse_time_value(match.group('request_time'))
+                        if url is None or request_time is None:
+                            if monitor:
+                                monitor.add_failed(match.group(0))
+                            continue
+                        log_stats.add(url, request_time)
+                if line_start < block_end and monitor and monitor.needs_examples:
+                    monitor.add_unmatched(mm[line_start:block_end])
+
+                log_stats.check_errors()
+
+    return log_stats
+
+
+def get_gzip_batches(
+        log: str,
+        batch_size: int,
+        gzip_backend: str = GZIP_BACKEND_PYTHON
+) -> Generator[list[bytes], None, None]:
+    with open_log(log, gzip_backend) as f:
+        while batch := list(islice(f, batch_size)):
+            yield batch
+
+
+def get_mmap_parser(parser: Callable) -> Optional[LogFormatParser]:
+    """Парсер для pars_log_mmap: None означает встроенный LOG_BYTES_COMPILED."""
+    return parser if isinstance(parser, LogFormatParser) else None
+
+
+def get_log_data_parallel(
+        log: str,
+        parser: Callable,
+        workers: int,
+        decode: bool = True,
+        log_stats: Optional[LogStats] = None,
+        gzip_backend: str = GZIP_BACKEND_PYTHON,
+        use_mmap: bool = False
+) -> LogStats:
+    """
+    Разбирает один лог в нескольких процессах. Несжатый файл делится на диапазоны байт,
+    каждый из которых читает свой процесс (при use_mmap - через общее отображение файла).
+    Архив распаковывается один раз в основном процессе, а строки пачками раздаются обработчикам;
+    количество пачек в очереди ограничено, чтобы распаковка не обгоняла разбор и не съедала память.
+    Частичные агрегаты объединяются в порядке следования в файле. Ошибка в обработчике
+    (например, LogParseError) отменяет еще не начатые задачи.
+    """
+    log_stats = log_stats or LogStats()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            _get_log_data_parallel(executor, log, parser, workers, decode, log_stats, gzip_backend, use_mmap)
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    return log_stats
+
+
+def _get_log_data_parallel(
+        executor: ProcessPoolExecutor,
+        log: str,
+        parser: Callable,
+        workers: int,
+        decode: bool,
+        log_stats: LogStats,
+        gzip_backend: str,
+        use_mmap: bool
+):
+    if is_gzip_file(log):
+        pending: deque = deque()
+        for batch in get_gzip_batches(log, GZIP_BATCH_SIZE, gzip_backend):
+            pending.append(executor.submit(pars_log_batch, batch, parser, decode, log_stats.spawn()))
+            if len(pending) >= workers * 2:
+                log_stats.merge(pending.popleft().result())
+                log_stats.check_errors()
+        while pending:
+            log_stats.merge(pending.popleft().result())
+    else:
+        futures = [
+            executor.submit(pars_log_mmap, log, start, end, log_stats.spawn(), get_mmap_parser(parser)) if use_mmap
+            else executor.submit(pars_log_chunk, log, start, end, parser, decode, log_stats.spawn())
+            for start, end in get_file_chunks(log, workers)
+        ]
+        for future in futures:
+            log_stats.merge(future.result())
+
+
+def get_log_data(
+        log: str,
+        parser: Callable,
+        workers: int = 1,
+        decode: bool = True,
+        log_stats: Optional[LogStats] = None,
+        gzip_backend: str = GZIP_BACKEND_PYTHON,
+        use_mmap: bool = False,
+        metrics: Metrics = NULL_METRICS
+) -> LogStats:
+    """
+    :param decode: передавать парсеру строки str (True) или сырые bytes (False)
+    :param log_stats: пустой агрегат с нужными настройками (например, MEDIAN_MODE)
+    :param gzip_backend: способ распаковки архивов, см. GZIP_BACKENDS
+    :param use_mmap: разбирать несжатый файл через mmap (только для парсеров pars_log_bytes и LogFormatParser)
+    :param metrics: метрики запуска: время этапа parse, прочитанные байты и строки, количество урлов
+    """
+    use_mmap = use_mmap and (parser is pars_log_bytes or isinstance(parser, LogFormatParser)) and not is_gzip_file(log)
+    with metrics.stage('parse'):
+        if workers > 1:
+            log_stats = get_log_data_parallel(log, parser, workers, decode, log_stats, gzip_backend, use_mmap)
+        elif use_mmap:
+            log_stats = pars_log_mmap(log, log_stats=log_stats, parser=get_mmap_parser(parser))
+        else:
+            log_stats = aggregate_lines(unpack_file(log, decode, gzip_backend, metrics), parser, log_stats)
+
+    size = os.path.getsize(log)
+    if log_stats.is_sampled and not use_mmap:
+        # Выборка строк по хэшу: в среднем читается ровно доля sample_rate
+        log_stats.add_sampled_bytes(size * log_stats.sample_rate, size)
+    metrics.incr('bytes_read', size)
+    metrics.record_log_stats(log_stats)
+    return log_stats
+
+
+class LogFollower:
+    """
+    Инкрементальное чтение дописываемого лога. Позиция запоминается как (inode, offset),
+    поэтому каждое чтение стоит пропорционально только новым байтам. Ротация определяется
+    по смене inode (файл переименован и создан новый) или уменьшению размера (truncate).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.inode: Optional[int] = None
+        self.offset = 0
+        self._file: Any = None
+        self._tail = b''
+
+    def _open(self) -> bool:
+        try:
+            self._file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        self.inode = os.fstat(self._file.fileno()).st_ino
+        self.offset = 0
+        self._tail = b''
+        return True
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _read_block(self) -> Optional[list[bytes]]:
+        """
+        Полные строки из следующих не более READ_BUFFER_SIZE байт; незавершенная последняя
+        строка переносится в следующий блок. None - новых данных нет.
+        """
+        if self._file is None and not self._open():
+            return None
+        data: bytes = self._file.read(READ_BUFFER_SIZE)
+        if not data:
+            return None
+        self.offset += len(data)
+        lines = (self._tail + data).split(b'\n')
+        self._tail = lines.pop()
+        return lines
+
+    def read_chunks(self) -> Generator[list[bytes], None, None]:
+        """
+        Полные строки (без перевода строки), дописанные с прошлого чтения, пачками по блокам
+        файла, чтобы накопившийся за время простоя лог не читался в память целиком.
+        """
+        while (lines := self._read_block()) is not None:
+            yield lines
+
+    def read_lines(self) -> list[bytes]:
+        """Все полные строки, дописанные с прошлого чтения."""
+        return [line for lines in self.read_chunks() for line in lines]
+
+    def check_rotation(self) -> Optional[list[bytes]]:
+        """
+        Если лог ротирован, дочитывает остаток прежнего файла (включая последнюю
+        незавершенную строку), переходит к новому файлу и возвращает остаток.
+        Если ротации не было, возвращает None.
+        """
+        if self._file is None:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if stat.st_ino == self.inode and stat.st_size >= self.offset:
+            return None
+
+        lines = self.read_lines()
+        if self._tail:
+            lines.append(self._tail)
+        self.close()
+        self._open()
+        return lines
+
+
+def is_enabled(value: Any) -> bool:
+    """Булево значение из конфига: в ini-файле все значения - строки."""
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_url_rewrites(value: str) -> list[tuple[Pattern, str]]:
+    """
+    Замены урлов из конфига: по одной на строку в виде "регулярное выражение => замена".
+    """
+    rewrites = []
+    for line in value.splitlines():
+        if not line.strip():
+            continue
+        pattern, _, replacement = line.partition('=>')
+        rewrites.append((re.compile(pattern.strip()), replacement.strip()))
+    return rewrites
+
+
+def create_error_monitor(conf: dict) -> ErrorMonitor:
+    return ErrorMonitor(float(conf['ERROR_THRESHOLD']), int(conf['ERROR_SAMPLE_SIZE']))
+
+
+def create_log_stats(conf: dict) -> LogStats:
+    """Пустой агрегат с настройками группировки из конфига."""
+    normalizer = None
+    if is_enabled(conf['URL_NORMALIZE']):
+        normalizer = UrlNormalizer(
+            [param.strip() for param in conf['URL_STRIP_PARAMS'].split(',') if param.strip()],
+            parse_url_rewrites(conf['URL_REWRITES']),
+        )
+    error_monitor = create_error_monitor(conf)
+    return LogStats(
+        conf['MEDIAN_MODE'],
+        normalizer,
+        int(conf['URL_MAX_KEYS']),
+        error_monitor,
+        float(conf['SAMPLE_RATE']),
+        get_group_by(conf),
+    )
+
+
+def get_group_by(conf: dict) -> tuple[str, ...]:
+    return tuple(name.strip() for name in conf['GROUP_BY'].split(',') if name.strip())
+
+
+def parse_log_format(value: str) -> str:
+    """
+    LOG_FORMAT можно скопировать из конфига nginx как есть: строки в одинарных кавычках
+    (в том числе на нескольких строках) склеиваются, как это делает nginx.
+    """
+    if "'" in value:
+        return ''.join(re.findall(r"'([^']*)'", value))
+    return value.strip()
+
+
+@lru_cache(maxsize=None)
+def get_log_format_parser(log_format: str, group_by: tuple[str, ...], time_field: str) -> LogFormatParser:
+    return LogFormatParser(log_format, group_by, time_field)
+
+
+def get_parser(conf: dict) -> Callable:
+    """
+    Встроенный pars_log_bytes, если формат лога, измерения и поле времени не менялись,
+    иначе LogFormatParser, скомпилированный один раз на процесс.
+    """
+    log_format, group_by, time_field = conf['LOG_FORMAT'], get_group_by(conf), conf['TIME_FIELD']
+    if not log_format and not group_by and time_field == 'request_time':
+        return pars_log_bytes
+    return get_log_format_parser(parse_log_format(log_format or DEFAULT_LOG_FORMAT), group_by, time_field)
+
+
+def get_aggregation_variant(conf: dict) -> str:
+    """Настройки, от которых зависит содержимое агрегата; входят в ключ кэша."""
+    keys = (
+        'MEDIAN_MODE', 'URL_NORMALIZE', 'URL_STRIP_PARAMS', 'URL_REWRITES', 'URL_MAX_KEYS', 'SAMPLE_RATE',
+        'LOG_FORMAT', 'GROUP_BY', 'TIME_FIELD',
+    )
+    return '|'.join(str(conf.get(key)) for key in keys)
+
+
+def get_cache_key(log: str, variant: str = '') -> str:
+    """
+    Ключ кэша агрегатов: путь, размер и время изменения файла, версия парсера
+    и настройки агрегации (variant), влияющие на содержимое LogStats.
+    """
+    stat = os.stat(log)
+    key = f'{os.path.abspath(log)}|{stat.st_size}|{stat.st_mtime_ns}|{PARSER_VERSION}|{variant}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_cache_dir(conf: dict) -> str:
+    """
+    Директория кэша агрегатов: CACHE_DIR, а если он не задан (null) - REPORT_DIR/.cache,
+    чтобы кэш не зависел от текущей директории. Пустая строка отключает кэш.
+    """
+    cache_dir = conf['CACHE_DIR']
+    if cache_dir is None:
+        return os.path.join(conf['REPORT_DIR'], CACHE_DIR_NAME)
+    return str(cache_dir)
+
+
+def get_cache_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key + CACHE_FILE_EXT)
+
+
+def load_cached_stats(
+        cache_dir: str,
+        key: str,
+        error_monitor: Optional[ErrorMonitor] = None
+) -> Optional[LogStats]:
+    """
+    Агрегат из кэша. error_monitor - монитор ошибок с текущими настройками: в него
+    добавляются сохраненные примеры нераспарсенных строк.
+    """
+    path = get_cache_path(cache_dir, key)
+    try:
+        with open(path, 'rb') as f:
+            cached: tuple[LogStats, list[Any]] = pickle.load(f)
+        log_stats, examples = cached
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError, ValueError, TypeError):
+        logger.warning(f'Поврежденный файл кэша {path} удален.')
+        os.remove(path)
+        return None
+    # Время доступа обновляется, чтобы вытеснялись самые давно используемые записи
+    os.utime(path)
+    if error_monitor:
+        for line in examples:
+            error_monitor.add_failed(line)
+    log_stats.error_monitor = error_monitor
+    return log_stats
+
+
+def save_cached_stats(cache_dir: str, key: str, log_stats: LogStats, max_size: int):
+    """
+    Сохраняет агрегат в кэш атомарно и вытесняет самые старые записи,
+    если общий размер кэша превышает max_size байт. Монитор ошибок сохраняется
+    только примерами строк: порог ERROR_THRESHOLD не входит в ключ кэша и берется
+    из конфига при загрузке (load_cached_stats).
+    """
+    # Кэш загружается через pickle, поэтому директория доступна только владельцу
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    path = get_cache_path(cache_dir, key)
+    error_monitor = log_stats.error_monitor
+    examples = error_monitor.examples if error_monitor else []
+    log_stats.error_monitor = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as f:
+            pickle.dump((log_stats, examples), f, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        log_stats.error_monitor = error_monitor
+    os.replace(f.name, path)
+    evict_cache(cache_dir, max_size)
+
+
+def evict_cache(cache_dir: str, max_size: int):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(CACHE_FILE_EXT):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Запись удалена параллельным процессом между scandir и stat
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Запись уже удалена параллельным процессом
+            pass
+        total_size -= size
+        logger.info(f'Запись кэша {path} вытеснена.')
+
+
+def clear_cache(cache_dir: str):
+    if not os.path.isdir(cache_dir):
+        return
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(CACHE_FILE_EXT):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def build_log_stats(log: str, conf: dict, metrics: Metrics = NULL_METRICS) -> LogStats:
+    """
+    Возвращает агрегат лога из кэша, если файл не менялся, иначе разбирает лог
+    и сохраняет агрегат в кэш (CACHE_DIR, размер ограничен CACHE_SIZE мегабайт).
+    """
+    cache_dir = get_cache_dir(conf)
+    key = get_cache_key(log, get_aggregation_variant(conf))
+    if cache_dir:
+        with metrics.stage('cache_load'):
+            log_stats = load_cached_stats(cache_dir, key, create_error_monitor(conf))
+        if log_stats:
+            logger.info(f'Агрегат лога {get_filename_from_path(log)} взят из кэша.')
+            metrics.set('distinct_urls', len(log_stats.urls))
+            return log_stats
+
+    log_stats = get_log_data(
+        log,
+        get_parser(conf),
+        int(conf['WORKERS']),
+        decode=False,
+        log_stats=create_log_stats(conf),
+        gzip_backend=str(conf['GZIP_BACKEND']),
+        use_mmap=is_enabled(conf['MMAP']),
+        metrics=metrics,
+    )
+    if cache_dir:
+        with metrics.stage('cache_save'):
+            save_cached_stats(cache_dir, key, log_stats, int(conf['CACHE_SIZE']) * 1024 * 1024)
+    return log_stats
+
+
+def load_source_stats(log: str, conf: dict) -> LogStats:
+    """Агрегат лога одного источника; лог с недопустимой долей ошибок - ошибка всего дня."""
+    log_stats = build_log_stats(log, conf)
+    try:
+        log_stats.check_errors(final=True)
+    except LogParseError as e:
+        raise LogParseError(f'файл {log}: {e}') from e
+    return log_stats
+
+
+def get_fleet_workers(logs: list[str], conf: dict) -> int:
+    """Источников обычно больше, чем ядер: по умолчанию каждое ядро разбирает свой лог."""
+    return max(1, min(len(logs), max(int(conf['WORKERS']), os.cpu_count() or 1)))
+
+
+def build_fleet_log_stats(logs: list[str], conf: dict, metrics: Metrics = NULL_METRICS) -> LogStats:
+    """
+    Общий агрегат по логам всех источников за день. Каждый лог читается, распаковывается
+    и разбирается целиком в отдельном процессе (с кэшем агрегатов, как и одиночный лог),
+    поэтому источники обрабатываются одновременно, даже при WORKERS=1 (см. get_fleet_workers).
+    Готовые агрегаты сливаются в общий в порядке источников, так что результат не зависит
+    от того, какой лог разобран первым. Ошибка разбора любого источника (LogParseError)
+    отменяет еще не начатые задачи: отчет без части хостов не строится.
+    """
+    log_stats = create_log_stats(conf)
+    source_conf = {**conf, 'WORKERS': 1}
+    with metrics.stage('parse'):
+        with ProcessPoolExecutor(max_workers=get_fleet_workers(logs, conf)) as executor:
+            try:
+                futures = [executor.submit(load_source_stats, log, source_conf) for log in logs]
+                for future in futures:
+                    log_stats.merge(future.result())
+                    metrics.incr('sources_parsed', 1)
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    metrics.incr('bytes_read', sum(os.path.getsize(log) for log in logs))
+    metrics.record_log_stats(log_stats)
+    return log_stats
+
+
+def build_fleet_report(day: FleetDay, conf: dict, metrics: Metrics = NULL_METRICS) -> bool:
+    """
+    Общий отчет за день. Если хотя бы один источник не разобран, отчет не публикуется,
+    чтобы день не считался обработанным и был построен заново при следующем запуске.
+    """
+    try:
+        log_stats = build_fleet_log_stats(day.filenames, conf, metrics)
+    except LogParseError as e:
+        logger.error(f'Отчет за {day.date} не построен, {e}')
+        return False
+
+    publish_report(get_report_name(day.filenames[0], float(conf['SAMPLE_RATE'])), log_stats, conf, metrics)
+    return True
+
+
+def publish_report(report_name: str, log_stats: LogStats, conf: dict, metrics: Metrics = NULL_METRICS):
+    """
+    Отчет и, если задан EXPORT_DIR, колоночный экспорт агрегатов EXPORT_SIZE урлов
+    (0 - всех). Экспорт пишется первым: по наличию отчета лог считается обработанным.
+    """
+    export_dir = conf['EXPORT_DIR']
+    export_size = int(conf['EXPORT_SIZE']) or len(log_stats.urls)
+    if export_dir and (data_for_export := get_data_for_render(log_stats, export_size)):
+        with metrics.stage('export'):
+            os.makedirs(export_dir, exist_ok=True)
+            write_export(
+                os.path.join(export_dir, get_export_name(report_name)),
+                data_for_export,
+                is_enabled(conf['EXPORT_COMPRESS']),
+            )
+    if data_for_render := get_data_for_render(log_stats, int(conf['REPORT_SIZE']), metrics):
+        create_report(report_name, data_for_render, conf['REPORT_DIR'], metrics)
+
+
+def publish_live_report(log_stats: LogStats, conf: dict):
+    if data_for_render := get_data_for_render(log_stats, int(conf['REPORT_SIZE'])):
+        create_report(LIVE_REPORT_NAME, data_for_render, conf['REPORT_DIR'])
+
+
+def aggregate_followed_lines(path: str, lines: Iterable[bytes], parser: Callable, log_stats: LogStats) -> LogStats:
+    """
+    Добавляет строки активного лога в агрегат. Если доля нераспарсенных строк превышена,
+    ошибка пишется в лог, агрегат начинается заново и слежение продолжается
+    с той же строки, на которой была обнаружена ошибка.
+    """
+    lines = iter(lines)
+    while True:
+        try:
+            return aggregate_lines(lines, parser, log_stats)
+        except LogParseError as e:
+            logger.error(f'Лог {path}: {e}')
+            log_stats = log_stats.spawn()
+
+
+def follow_log(conf: dict, parser: Optional[Callable] = None):
+    """
+    Режим --follow: каждые FOLLOW_INTERVAL секунд дочитывает новые строки активного
+    лога в накопленный агрегат и обновляет LIVE_REPORT_NAME. После ротации лога
+    агрегат начинается заново, так как прошедший день покрывается обычным отчетом.
+    """
+    path = conf['FOLLOW_LOG'] or os.path.join(conf['LOG_DIR'], ACTIVE_LOG_NAME)
+    interval = float(conf['FOLLOW_INTERVAL'])
+    follower = LogFollower(path)
+    parser = parser or get_parser(conf)
+    log_stats = create_log_stats(conf)
+    logger.info(f'Слежение за логом {path}, интервал обновления {interval} с.')
+    try:
+        while True:
+            for lines in follower.read_chunks():
+                log_stats = aggregate_followed_lines(path, lines, parser, log_stats)
+            if (rest := follower.check_rotation()) is not None:
+                log_stats = aggregate_followed_lines(path, rest, parser, log_stats)
+                publish_live_report(log_stats, conf)
+                logger.info(f'Лог {path} ротирован, агрегат начат заново.')
+                log_stats = log_stats.spawn()
+                continue
+
+            publish_live_report(log_stats, conf)
+            time.sleep(interval)
+    finally:
+        follower.close()
+
+
+def build_report(log: str, conf: dict, metrics: Metrics = NULL_METRICS) -> bool:
+    filename = get_filename_from_path(log)
+    try:
+        log_stats = build_log_stats(log, conf, metrics)
+        log_stats.check_errors(final=True)
+    except LogParseError as e:
+        logger.error(f'Файл {filename}: {e}')
+        return False
+
+    publish_report(get_report_name(log, float(conf['SAMPLE_RATE'])), log_stats, conf, metrics)
+    return True
+
+
+def get_pending_logs(
+        log_files: list[File],
+        report_dir: str,
+        since: Optional[date] = None,
+        index: Optional[LogIndex] = None,
+        sample_rate: float = 1
+) -> list[File]:
+    """
+    Логи, для которых еще нет отчета, начиная с даты since (если указана). При выборке
+    (sample_rate < 1) ищутся отчеты по выборке, полный отчет за день их не заменяет.
+    """
+    return [
+        log_file for log_file in log_files
+        if (not since or log_file.date >= since)
+        and not (
+            index.is_reported(log_file.filename, report_dir, sample_rate) if index
+            else os.path.exists(os.path.join(report_dir, get_report_name(log_file.filename, sample_rate)))
+        )
+    ]
+
+
+def process_log_file(log: str, conf: dict) -> tuple[str, bool, float]:
+    start_time = time.time()
+    try:
+        is_success = build_report(log, conf)
+    except Exception as e:
+        logger.exception(e)
+        is_success = False
+    return log, is_success, time.time() - start_time
+
+
+def backfill(log_files: list, conf: dict) -> list[tuple[str, bool, float]]:
+    """
+    Строит отчеты по списку логов в пуле из WORKERS процессов; каждый лог при этом
+    разбирается в одном процессе. Возвращает (лог, успех, время в секундах) по каждому файлу.
+    """
+    workers = int(conf['WORKERS'])
+    file_conf = {**conf, 'WORKERS': 1}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_log_file, log_file.filename, file_conf) for log_file in log_files]
+        return [future.result() for future in as_completed(futures)]
+
+
+def print_backfill_summary(results: list[tuple[str, bool, float]]):
+    for log, is_success, seconds in sorted(results):
+        status = 'ok' if is_success else 'error'
+        print(f'{get_filename_from_path(log)}\t{status}\t{seconds:.2f} s')
+    failed = sum(1 for _, is_success, _ in results if not is_success)
+    print(f'Обработано файлов: {len(results)}, с ошибкой: {failed}')
+
+
+def get_rollup_report_name(log_files: list) -> str:
+    dates = [log_file.date for log_file in log_files]
+    return f"report-rollup-{min(dates):%Y.%m.%d}-{max(dates):%Y.%m.%d}.html"
+
+
+def rollup(log_files: list, conf: dict) -> LogStats:
+    """
+    Объединяет агрегаты нескольких дней в один. Агрегаты берутся из кэша (CACHE_DIR);
+    лог разбирается заново только если его агрегата в кэше нет. Количество, суммы,
+    максимумы и распределения request_time складываются без потери точности,
+    в том числе приближенные (TimeSketch). Каждый день проходит ту же итоговую проверку
+    доли ошибок, что и обычный отчет: день с недопустимой долей ошибок прерывает сводку
+    LogParseError.
+    """
+    log_stats = create_log_stats(conf)
+    for log_file in log_files:
+        day_stats = build_log_stats(log_file.filename, conf)
+        try:
+            day_stats.check_errors(final=True)
+        except LogParseError as e:
+            raise LogParseError(f'файл {get_filename_from_path(log_file.filename)}: {e}') from e
+        log_stats.merge(day_stats)
+    return log_stats
+
+
+def parse_date_arg(value: str) -> Optional[date]:
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        logger.error(f'Некорректная дата {value}, ожидается ГГГГ-ММ-ДД')
+        sys.exit(1)
 
 
 def main():
     args = get_args()
     conf = get_config(CONFIG, parse_config(args))
+    if args.sample is not None:
+        conf['SAMPLE_RATE'] = args.sample
     dictConfig(get_logging_config(conf.get('LOGGING_FILE_PATH')))
+    metrics = Metrics()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        run(args, conf, metrics)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        metrics.emit()
+        if metrics_file := conf['METRICS_FILE']:
+            metrics.write(metrics_file)
+
+
+def run(args: optparse.Values, conf: dict, metrics: Metrics):
+    if args.invalidate_cache:
+        if cache_dir := get_cache_dir(conf):
+            clear_cache(cache_dir)
+        logger.info('Кэш агрегатов очищен.')
+        sys.exit(0)
+
+    median_mode = conf['MEDIAN_MODE']
+    if median_mode not in (MEDIAN_EXACT, MEDIAN_APPROX):
+        logger.error(f'Неизвестный режим расчета медианы {median_mode}')
+        sys.exit(1)
+
+    if conf['GZIP_BACKEND'] not in GZIP_BACKENDS:
+        logger.error(f'Неизвестный способ распаковки {conf["GZIP_BACKEND"]}')
+        sys.exit(1)
+
     try:
-        last_log_file = get_log_files(conf.get('LOG_DIR'))[0]
-    except IndexError:
+        get_parser(conf)
+    except ValueError as e:
+        logger.error(f'Неверный LOG_FORMAT: {e}')
+        sys.exit(1)
+
+    if not 0 < float(conf['SAMPLE_RATE']) <= 1:
+        logger.error(f'Доля выборки SAMPLE_RATE должна быть в диапазоне (0, 1], указано {conf["SAMPLE_RATE"]}')
+        sys.exit(1)
+
+    if args.follow:
+        follow_log(conf)
+        return
+
+    if conf['LOG_DIRS']:
+        process_fleet_logs(args, conf, metrics)
+        return
+
+    index = LogIndex(index_path) if (index_path := conf['LOG_INDEX_FILE']) else None
+    try:
+        process_logs(args, conf, metrics, index)
+    finally:
+        if index:
+            index.save()
+
+
+def rollup_report(log_files: list, since: Optional[date], until: Optional[date], conf: dict, metrics: Metrics):
+    period_files = [
+        log_file for log_file in log_files
+        if (not since or log_file.date >= since) and (not until or log_file.date <= until)
+    ]
+    if not period_files:
+        logger.error('Нет логов за указанный период.')
+        sys.exit(1)
+    try:
+        with metrics.stage('rollup'):
+            log_stats = rollup(period_files, conf)
+    except LogParseError as e:
+        logger.error(f'Сводный отчет не построен, {e}')
+        sys.exit(1)
+    publish_report(get_rollup_report_name(period_files), log_stats, conf, metrics)
+
+
+def process_fleet_logs(args: optparse.Values, conf: dict, metrics: Metrics):
+    """
+    Режим нескольких источников (LOG_DIRS): один отчет за день по логам всех директорий.
+    Индекс LOG_INDEX_FILE в этом режиме не используется.
+    """
+    report_dir = conf['REPORT_DIR']
+    sample_rate = float(conf['SAMPLE_RATE'])
+    since, until = parse_date_arg(args.since), parse_date_arg(args.until)
+    days = get_fleet_log_files(get_log_dirs(conf), metrics)
+    if not days:
         logger.error('Файлов с логами не найдено.')
         sys.exit(1)
 
-    last_log = last_log_file.filename
-    report_name = get_report_name(last_log)
-    report_dir = conf.get('REPORT_DIR')
-    filename = get_filename_from_path(last_log)
+    if args.rollup:
+        log_files = [File(filename, day.date) for day in days for filename in day.filenames]
+        rollup_report(log_files, since, until, conf, metrics)
+        return
+
+    if args.all or args.since:
+        pending_days = [
+            day for day in days
+            if (not since or day.date >= since)
+            and not os.path.exists(os.path.join(report_dir, get_report_name(day.filenames[0], sample_rate)))
+        ]
+        with metrics.stage('backfill'):
+            results = [build_fleet_report(day, conf, metrics) for day in reversed(pending_days)]
+        logger.info(f'Построено отчетов: {sum(results)}, с ошибкой: {len(results) - sum(results)}')
+        if not all(results):
+            sys.exit(1)
+        return
 
-    if os.path.exists(os.path.join(report_dir, report_name)):
+    last_day = days[0]
+    report_name = get_report_name(last_day.filenames[0], sample_rate)
+    if not args.force and os.path.exists(os.path.join(report_dir, report_name)):
         logger.info(f'Отчет {report_name} существует.')
         sys.exit(0)
 
-    results, requests_count = get_log_data(last_log, pars_log)
-    if get_perc(requests_count, len(results)) < 50:
-        logger.error(f'Неудалось распарсить больше половины файла {filename}')
+    logger.info(f'Отчет за {last_day.date} по {len(last_day.filenames)} логам.')
+    if not build_fleet_report(last_day, conf, metrics):
         sys.exit(1)
 
-    if data_for_render := get_data_for_render(results, requests_count, conf.get('REPORT_SIZE')):
-        create_report(report_name, data_for_render, report_dir)
+
+def process_logs(args: optparse.Values, conf: dict, metrics: Metrics, index: Optional[LogIndex] = None):
+    log_dir, report_dir = conf['LOG_DIR'], conf['REPORT_DIR']
+    sample_rate = float(conf['SAMPLE_RATE'])
+    since, until = parse_date_arg(args.since), parse_date_arg(args.until)
+    if args.rollup:
+        rollup_report(get_log_files(log_dir, metrics, index), since, until, conf, metrics)
+        return
+
+    if args.all or args.since:
+        log_files = get_log_files(log_dir, metrics, index)
+        if not log_files:
+            logger.error('Файлов с логами не найдено.')
+            sys.exit(1)
+        with metrics.stage('backfill'):
+            results = backfill(get_pending_logs(log_files, report_dir, since, index, sample_rate), conf)
+        print_backfill_summary(results)
+        if index:
+            for log, is_success, _ in results:
+                if is_success and os.path.exists(os.path.join(report_dir, get_report_name(log, sample_rate))):
+                    index.mark_reported(log, report_dir, sample_rate)
+        if not all(is_success for _, is_success, _ in results):
+            sys.exit(1)
+        return
+
+    last_log_file = get_last_log_file(log_dir, metrics, index)
+    if not last_log_file:
+        logger.error('Файлов с логами не найдено.')
+        sys.exit(1)
+
+    last_log = last_log_file.filename
+    report_name = get_report_name(last_log, sample_rate)
+    if not args.force and os.path.exists(os.path.join(report_dir, report_name)):
+        logger.info(f'Отчет {report_name} существует.')
+        sys.exit(0)
+
+    if not build_report(last_log, conf, metrics):
+        sys.exit(1)
+    if index and os.path.exists(os.path.join(report_dir, report_name)):
+        index.mark_reported(last_log, report_dir, sample_rate)
 
 
 if __name__ == "__main__":
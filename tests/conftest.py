@@ -66,6 +66,9 @@ def data_for_render_result():
             'time_sum': 2.434,
             'url': '/api/v2/banner/23640143',
             'time_med': 2.434,
+            'time_p90': 2.434,
+            'time_p95': 2.434,
+            'time_p99': 2.434,
             'time_perc': 43.48758263355369,
             'count_perc': 5.0
         },
@@ -76,6 +79,9 @@ def data_for_render_result():
             'time_sum': 0.505,
             'url': '/api/v2/group/7130079/banners',
             'time_med': 0.505,
+            'time_p90': 0.505,
+            'time_p95': 0.505,
+            'time_p99': 0.505,
             'time_perc': 9.022690727175272,
             'count_perc': 5.0
         },
@@ -86,6 +92,9 @@ def data_for_render_result():
             'time_sum': 0.358,
             'url': '/api/v2/banner/1279875',
             'time_med': 0.358,
+            'time_p90': 0.358,
+            'time_p95': 0.358,
+            'time_p99': 0.358,
             'time_perc': 6.396283723423262,
             'count_perc': 5.0
         },
@@ -96,6 +105,9 @@ def data_for_render_result():
             'time_sum': 0.353,
             'url': '/api/v2/banner/23796798',
             'time_med': 0.353,
+            'time_p90': 0.353,
+            'time_p95': 0.353,
+            'time_p99': 0.353,
             'time_perc': 6.3069501518670705,
             'count_perc': 5.0
         },
@@ -106,6 +118,9 @@ def data_for_render_result():
             'time_sum': 0.27,
             'url': '/api/v2/banner/22521090',
             'time_med': 0.27,
+            'time_p90': 0.27,
+            'time_p95': 0.27,
+            'time_p99': 0.27,
             'time_perc': 4.824012864034304,
             'count_perc': 5.0
         },
@@ -116,6 +131,9 @@ def data_for_render_result():
             'time_sum': 0.208,
             'url': '/api/1/campaigns/?id=3512434',
             'time_med': 0.208,
+            'time_p90': 0.208,
+            'time_p95': 0.208,
+            'time_p99': 0.208,
             'time_perc': 3.7162765767375374,
             'count_perc': 5.0
         },
@@ -126,6 +144,9 @@ def data_for_render_result():
             'time_sum': 0.161,
             'url': '/api/v2/banner/23904631',
             'time_med': 0.161,
+            'time_p90': 0.161,
+            'time_p95': 0.161,
+            'time_p99': 0.161,
             'time_perc': 2.876541004109344,
             'count_perc': 5.0
         },
@@ -136,6 +157,9 @@ def data_for_render_result():
             'time_sum': 0.156,
             'url': '/api/v2/banner/16852664',
             'time_med': 0.156,
+            'time_p90': 0.156,
+            'time_p95': 0.156,
+            'time_p99': 0.156,
             'time_perc': 2.7872074325531533,
             'count_perc': 5.0
         },
@@ -146,6 +170,9 @@ def data_for_render_result():
             'time_sum': 0.154,
             'url': '/api/v2/banner/15521472',
             'time_med': 0.154,
+            'time_p90': 0.154,
+            'time_p95': 0.154,
+            'time_p99': 0.154,
             'time_perc': 2.751474003930677,
             'count_perc': 5.0
         },
@@ -156,6 +183,9 @@ def data_for_render_result():
             'time_sum': 0.152,
             'url': '/api/1/campaigns/?id=512672',
             'time_med': 0.152,
+            'time_p90': 0.152,
+            'time_p95': 0.152,
+            'time_p99': 0.152,
             'time_perc': 2.7157405753082005,
             'count_perc': 5.0
         },
@@ -166,6 +196,9 @@ def data_for_render_result():
             'time_sum': 0.147,
             'url': '/api/1/campaigns/?id=498119',
             'time_med': 0.147,
+            'time_p90': 0.147,
+            'time_p95': 0.147,
+            'time_p99': 0.147,
             'time_perc': 2.6264070037520098,
             'count_perc': 5.0
         },
@@ -176,6 +209,9 @@ def data_for_render_result():
             'time_sum': 0.144,
             'url': '/api/1/campaigns/?id=3887786',
             'time_med': 0.144,
+            'time_p90': 0.144,
+            'time_p95': 0.144,
+            'time_p99': 0.144,
             'time_perc': 2.5728068608182952,
             'count_perc': 5.0
         },
@@ -186,6 +222,9 @@ def data_for_render_result():
             'time_sum': 0.125,
             'url': '/agency/outgoings_stats/?date1=29-06-2017&date2=29-06-2017&date_type=day&do=1&rt=banner&oi=26647045&as_json=1',
             'time_med': 0.125,
+            'time_p90': 0.125,
+            'time_p95': 0.125,
+            'time_p99': 0.125,
             'time_perc': 2.2333392889047703,
             'count_perc': 5.0
         },
@@ -196,6 +235,9 @@ def data_for_render_result():
             'time_sum': 0.086,
             'url': '/api/v2/group/6266784/statistic/sites/?date_type=week&date_to=2017-07-02&date_from=2017-06-26',
             'time_med': 0.086,
+            'time_p90': 0.086,
+            'time_p95': 0.086,
+            'time_p99': 0.086,
             'time_perc': 1.5365374307664819,
             'count_perc': 5.0
         },
@@ -206,6 +248,9 @@ def data_for_render_result():
             'time_sum': 0.078,
             'url': '/agency/outgoings_stats/?date1=29-06-2017&date2=29-06-2017&date_type=day&do=1&rt=banner&oi=23894002&as_json=1',
             'time_med': 0.078,
+            'time_p90': 0.078,
+            'time_p95': 0.078,
+            'time_p99': 0.078,
             'time_perc': 1.3936037162765766,
             'count_perc': 5.0
         }
@@ -1,19 +1,73 @@
+import gzip
+import json
 import os
 import pytest
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 
 from log_analyzer import (
     CONFIG,
+    DEFAULT_LOG_FORMAT,
+    LIVE_REPORT_NAME,
+    MEDIAN_APPROX,
+    OTHER_URL,
+    SKETCH_ACCURACY,
+    ErrorMonitor,
+    ExportReader,
+    LogFollower,
+    LogFormatParser,
+    LogIndex,
+    LogParseError,
+    LogStats,
+    Metrics,
+    TimeHistogram,
+    TimeSketch,
+    UrlNormalizer,
+    backfill,
+    build_fleet_log_stats,
+    build_fleet_report,
+    build_log_stats,
+    build_report,
+    clear_cache,
+    create_log_stats,
     create_report,
+    evict_cache,
+    follow_log,
+    get_cache_dir,
+    get_cache_key,
     get_config,
     get_data_for_render,
+    get_export_name,
+    get_file_chunks,
     get_filename_from_path,
+    get_fleet_log_files,
+    get_fleet_workers,
+    get_last_log_file,
     get_log_data,
+    get_log_dirs,
     get_log_files,
+    get_parser,
+    get_pending_logs,
     get_perc,
+    get_report_data_name,
     get_report_name,
+    get_rollup_report_name,
+    get_sampled_blocks,
     is_gzip_file,
+    load_cached_stats,
     pars_log,
-    unpack_file
+    pars_log_bytes,
+    pars_log_fields,
+    pars_log_mmap,
+    parse_log_format,
+    parse_url_rewrites,
+    rollup,
+    save_cached_stats,
+    unpack_file,
+    write_export
 )
 
 
@@ -29,6 +83,11 @@ def test_get_report_name(filename, result):
     assert test_result == result
 
 
+def test_get_report_name_sample():
+    assert get_report_name('nginx-access-ui.log-20170630.gz', 0.1) == 'report-2017.06.30.sample.html'
+    assert get_report_name('nginx-access-ui.log-20170630.gz', 1) == 'report-2017.06.30.html'
+
+
 @pytest.mark.parametrize('filename, result', [  # noqa
     ('nginx-access-ui.log-20170630.gzz', False),
     ('./root/nginx-access-ui.log-20170630.gz', True),
@@ -57,29 +116,141 @@ def test_get_log_files(create_log_files):
                           "date=datetime.date(2018, 6, 30))]"
 
 
+def test_get_last_log_file(create_log_files, tmp_path):
+    assert get_last_log_file('./log_tmp') == get_log_files('./log_tmp')[0]
+    assert get_last_log_file(str(tmp_path)) is None
+
+
+def test_log_index(tmp_path, monkeypatch):
+    log_dir, report_dir = tmp_path / 'log', tmp_path / 'reports'
+    log_dir.mkdir()
+    report_dir.mkdir()
+    for day in ('20170629', '20170630'):
+        (log_dir / f'nginx-access-ui.log-{day}.gz').touch()
+    (log_dir / 'nginx-access-ui.log-2017.gz').touch()
+    (log_dir / 'nginx-access-acc.log-20170630').touch()
+    old = time.time() - 60
+    os.utime(log_dir, (old, old))
+    os.utime(report_dir, (old, old))
+
+    index_path = str(tmp_path / 'index.json')
+    index = LogIndex(index_path)
+    assert get_log_files(str(log_dir), index=index) == get_log_files(str(log_dir))
+    (report_dir / 'report-2017.06.29.html').touch()
+    os.utime(report_dir, (old, old))
+    assert [log.date for log in get_pending_logs(get_log_files(str(log_dir)), str(report_dir), index=index)] == [
+        date(2017, 6, 30)
+    ]
+    index.save()
+
+    # Директория не изменилась: индекс не сканирует ее и не разбирает имена
+    parsed = []
+    monkeypatch.setattr('log_analyzer.parse_file_date', lambda name: parsed.append(name))
+    index = LogIndex(index_path)
+    assert get_last_log_file(str(log_dir), index=index).date == date(2017, 6, 30)
+    assert index.is_reported(str(log_dir / 'nginx-access-ui.log-20170629.gz'), str(report_dir))
+    assert parsed == []
+
+    # Новый файл: разбирается только его имя
+    monkeypatch.undo()
+    (log_dir / 'nginx-access-ui.log-20170701').touch()
+    assert get_last_log_file(str(log_dir), index=index).date == date(2017, 7, 1)
+    assert index.files.keys() == {
+        'nginx-access-ui.log-20170629.gz', 'nginx-access-ui.log-20170630.gz', 'nginx-access-ui.log-20170701'
+    }
+
+    # Отчет удален: отметка перепроверяется
+    (report_dir / 'report-2017.06.29.html').unlink()
+    assert not index.is_reported(str(log_dir / 'nginx-access-ui.log-20170629.gz'), str(report_dir))
+    (report_dir / 'report-2017.07.01.html').touch()
+    index.mark_reported(str(log_dir / 'nginx-access-ui.log-20170701'), str(report_dir))
+    index.save()
+    assert LogIndex(index_path).reported == {'report-2017.07.01.html'}
+
+
 def test_get_log_data(create_log_files, log_data_result):
-    result, count = get_log_data('./log_tmp/nginx-access-acc.log-20200430', pars_log)
-    assert count == 10
-    assert result == log_data_result
+    result = get_log_data('./log_tmp/nginx-access-acc.log-20200430', pars_log)
+    assert result.requests_count == 10
+    assert result.parsed_count == 10
+    assert [(url, result.time_sums[url_id]) for url, url_id in result.urls.items()] == [
+        (url, float(request_time)) for url, request_time in log_data_result
+    ]
 
 
-def test_create_report(log_data_result, create_report_dir):
+def test_create_report(data_for_render_result, create_report_dir):
     report_name = 'report-2017.06.30.html'
-    create_report(report_name=report_name, data=log_data_result, report_dir=create_report_dir)
-    assert os.path.exists(os.path.join(create_report_dir, report_name))
+    data_name = 'report-2017.06.30.data.js'
+    data_for_render_result[0]['url'] = '/api/</script>'
+    create_report(report_name=report_name, data=data_for_render_result, report_dir=create_report_dir)
+    assert sorted(os.listdir(create_report_dir)) == [data_name, report_name]
 
     with open(os.path.join(create_report_dir, report_name), 'r') as f:
         result = f.read()
-        assert len(result) == 4293
+    assert '$data_file' not in result
+    assert f'var DATA_FILE = "{data_name}";' in result
+
+    with open(os.path.join(create_report_dir, data_name), 'r') as f:
+        result = f.read()
+    assert result.startswith('window.reportData = ') and result.endswith(';\n')
+    assert '</script>' not in result
+    table = json.loads(result[len('window.reportData = '):-2])
+    assert list(table) == list(data_for_render_result[0])
+    assert table['url'] == [row['url'] for row in data_for_render_result]
+    assert table['count'] == [row['count'] for row in data_for_render_result]
+    assert table['time_perc'] == [round(row['time_perc'], 3) for row in data_for_render_result]
+
+
+def test_create_report_concurrent(data_for_render_result, create_report_dir):
+    # Каждый отчет пишется через собственный временный файл, параллельные записи не мешают друг другу
+    report_names = [f'report-2017.06.{day:02}.html' for day in range(1, 21)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda name: create_report(name, data_for_render_result, create_report_dir), report_names))
+
+    expected = sorted(report_names + [name.replace('.html', '.data.js') for name in report_names])
+    assert sorted(os.listdir(create_report_dir)) == expected
+    for name in report_names:
+        with open(os.path.join(create_report_dir, name)) as f:
+            assert f'"{name.replace(".html", ".data.js")}"' in f.read()
+
+
+DEFAULT_CONFIG = {
+    'REPORT_SIZE': 1000,
+    'REPORT_DIR': './reports',
+    'LOG_DIR': './log',
+    'WORKERS': 1,
+    'MEDIAN_MODE': 'exact',
+    'CACHE_DIR': None,
+    'CACHE_SIZE': 1024,
+    'FOLLOW_LOG': '',
+    'FOLLOW_INTERVAL': 60,
+    'URL_NORMALIZE': False,
+    'URL_STRIP_PARAMS': '_',
+    'URL_REWRITES': '',
+    'URL_MAX_KEYS': 0,
+    'GZIP_BACKEND': 'auto',
+    'MMAP': True,
+    'METRICS_FILE': '',
+    'ERROR_THRESHOLD': 50,
+    'ERROR_SAMPLE_SIZE': 10000,
+    'SAMPLE_RATE': 1,
+    'LOG_INDEX_FILE': '',
+    'LOG_DIRS': '',
+    'LOG_FORMAT': '',
+    'GROUP_BY': '',
+    'TIME_FIELD': 'request_time',
+    'EXPORT_DIR': '',
+    'EXPORT_SIZE': 0,
+    'EXPORT_COMPRESS': False,
+}
 
 
 @pytest.mark.parametrize('config_args, result', [  # noqa
-    ({'any': 1}, {'REPORT_SIZE': 1000, 'REPORT_DIR': './reports', 'LOG_DIR': './log', 'any': 1}),
-    ({}, {'LOG_DIR': './log', 'REPORT_DIR': './reports', 'REPORT_SIZE': 1000}),
-    (None, {'LOG_DIR': './log', 'REPORT_DIR': './reports', 'REPORT_SIZE': 1000}),
+    ({'any': 1}, {**DEFAULT_CONFIG, 'any': 1}),
+    ({}, DEFAULT_CONFIG),
+    (None, DEFAULT_CONFIG),
     (
         {'REPORT_DIR': './other', 'REPORT_SIZE': 1500},
-        {'LOG_DIR': './log', 'REPORT_DIR': './other', 'REPORT_SIZE': 1500}
+        {**DEFAULT_CONFIG, 'REPORT_DIR': './other', 'REPORT_SIZE': 1500}
     ),
 ])
 def test_get_config(config_args, result):
@@ -108,5 +279,857 @@ def test_unpack_file(create_log_files, mock_log_file_list):
 
 
 def test_get_data_for_render(mock_logs_data, data_for_render_result):
-    result = get_data_for_render(mock_logs_data, 20, 15)
+    log_stats = LogStats()
+    log_stats.requests_count = 20
+    for url, request_time in mock_logs_data:
+        log_stats.add(url, request_time)
+
+    result = get_data_for_render(log_stats, 15)
     assert result == data_for_render_result
+
+
+@pytest.mark.parametrize('times', [  # noqa
+    [0.5],
+    [0.1, 0.3],
+    [0.1, 0.1, 0.3, 0.7],
+    [0.2, 0.1, 0.2, 0.9, 0.2, 0.4],
+    [0.003, 1.5, 0.003, 0.2, 0.9],
+])
+def test_time_histogram_median(times):
+    histogram = TimeHistogram()
+    for request_time in times:
+        histogram.add(request_time)
+
+    assert histogram.median() == statistics.median(times)
+    assert histogram.quantile(0.5) == statistics.median_low(times)
+    assert histogram.quantile(1) == max(times)
+
+
+def test_log_stats_merge(mock_logs_data):
+    whole, first, second = LogStats(), LogStats(), LogStats()
+    for i, (url, request_time) in enumerate(mock_logs_data):
+        whole.add(url, request_time)
+        (first if i < 10 else second).add(url, request_time)
+
+    first.merge(second)
+    assert first.parsed_count == whole.parsed_count
+    assert list(first.urls) == list(whole.urls)
+    for url, url_id in whole.urls.items():
+        assert first.counts[first.urls[url]] == whole.counts[url_id]
+        assert first.time_maxes[first.urls[url]] == whole.time_maxes[url_id]
+        assert first.times[first.urls[url]].median() == whole.times[url_id].median()
+
+
+@pytest.mark.parametrize('chunks_count', [1, 3, 7, 50])  # noqa
+def test_get_file_chunks(create_log_files, chunks_count):
+    log = './log_tmp/nginx-access-acc.log-20200430'
+    chunks = get_file_chunks(log, chunks_count)
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == os.path.getsize(log)
+    with open(log, 'rb') as f:
+        content = f.read()
+    for (_, end), (start, _) in zip(chunks, chunks[1:]):
+        assert end == start
+        assert content[start - 1:start] == b'\n'
+
+
+@pytest.mark.parametrize('compress', [False, True])  # noqa
+def test_get_log_data_parallel(tmp_path, mock_log_file_list, compress):
+    log = str(tmp_path / ('nginx-access-ui.log-20170630' + ('.gz' if compress else '')))
+    with (gzip.open if compress else open)(log, 'wt') as f:
+        f.writelines(mock_log_file_list * 3)
+
+    expected = get_log_data(log, pars_log)
+    result = get_log_data(log, pars_log, workers=3)
+    bytes_result = get_log_data(log, pars_log_bytes, workers=3, decode=False)
+    assert list(bytes_result.urls) == list(expected.urls)
+    assert result.requests_count == expected.requests_count == 30
+    assert result.parsed_count == expected.parsed_count
+    assert list(result.urls) == list(expected.urls)
+    assert result.counts == expected.counts
+
+
+def test_pars_log_fields(mock_log_file_list):
+    for line in mock_log_file_list:
+        assert pars_log_fields(line) == pars_log(line)
+
+
+@pytest.mark.parametrize('line', [  # noqa
+    '',
+    'garbage\n',
+    '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET" 200 927 "-" "-" "-" "-" "-" 0.390\n',
+    '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1\n',
+])
+def test_pars_log_fields_invalid(line):
+    assert pars_log_fields(line) == []
+
+
+def test_pars_log_bytes(mock_log_file_list):
+    for line in mock_log_file_list:
+        assert pars_log_bytes(line.encode()) == [
+            (url, float(request_time)) for url, request_time in pars_log(line)
+        ]
+
+
+def test_pars_log_bytes_invalid_utf8(mock_log_file_list):
+    line = mock_log_file_list[0].replace('/api/', '/\udcff/').encode(errors='surrogateescape')
+    assert pars_log_bytes(line) == []
+
+
+@pytest.fixture()
+def combined_log(tmp_path):
+    """Лог в стандартном формате nginx combined, без $request_time."""
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_text(''.join(
+        f'1.1.1.{i} - - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{i} HTTP/1.1" 200 927 "-" '
+        f'"Mozilla/5.0 (X11; Linux x86_64) Firefox/3.0"\n'
+        for i in range(20)
+    ))
+    return log
+
+
+def test_pars_log_bytes_combined_format(combined_log):
+    line = combined_log.read_bytes().splitlines(keepends=True)[0]
+    assert pars_log_bytes(line) == []
+    result = get_log_data(str(combined_log), pars_log_bytes, decode=False)
+    assert (result.requests_count, result.parsed_count) == (20, 0)
+
+
+def test_get_log_data_bytes(tmp_path, mock_log_file_list):
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    lines = [line.encode() for line in mock_log_file_list]
+    lines[3] = lines[3].replace(b'/api/', b'/\xff\xfe/')
+    log.write_bytes(b''.join(lines))
+
+    result = get_log_data(str(log), pars_log_bytes, decode=False)
+    assert result.requests_count == 10
+    assert result.parsed_count == 9
+    assert all(isinstance(url, str) for url in result.urls)
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])  # noqa
+def test_time_sketch_accuracy(seed):
+    rnd = random.Random(seed)
+    exact, approx = TimeHistogram(), TimeSketch()
+    for _ in range(20000):
+        value = round(rnd.lognormvariate(-2, 1.5), 3)
+        exact.add(value)
+        approx.add(value)
+
+    for q in (0.5, 0.9, 0.95, 0.99):
+        assert approx.quantile(q) == pytest.approx(exact.quantile(q), rel=SKETCH_ACCURACY)
+
+
+def test_time_sketch_merge():
+    whole, first, second = TimeSketch(), TimeSketch(), TimeSketch()
+    for i in range(1000):
+        value = i / 100
+        whole.add(value)
+        (first if i % 2 else second).add(value)
+
+    first.merge(second)
+    assert first.zero_count == whole.zero_count
+    assert first.buckets == whole.buckets
+
+
+def test_get_data_for_render_approx(mock_logs_data, data_for_render_result):
+    log_stats = LogStats(MEDIAN_APPROX)
+    log_stats.requests_count = 20
+    for url, request_time in mock_logs_data:
+        log_stats.add(url, request_time)
+
+    result = get_data_for_render(log_stats, 15)
+    for row, expected in zip(result, data_for_render_result):
+        assert row['url'] == expected['url']
+        assert row['time_sum'] == expected['time_sum']
+        for key in ('time_med', 'time_p90', 'time_p95', 'time_p99'):
+            assert row[key] == pytest.approx(expected[key], rel=SKETCH_ACCURACY)
+
+
+def test_cache_key_changes_with_file(tmp_path):
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_text('line\n')
+    key = get_cache_key(str(log), 'exact')
+    assert key == get_cache_key(str(log), 'exact')
+    assert key != get_cache_key(str(log), 'approx')
+
+    log.write_text('line\nline\n')
+    assert key != get_cache_key(str(log), 'exact')
+
+
+def test_cache_save_load_evict(tmp_path, mock_logs_data):
+    cache_dir = str(tmp_path / 'cache')
+    log_stats = LogStats()
+    for url, request_time in mock_logs_data:
+        log_stats.add(url, request_time)
+
+    assert load_cached_stats(cache_dir, 'missing') is None
+    save_cached_stats(cache_dir, 'first', log_stats, 10 ** 9)
+    cached = load_cached_stats(cache_dir, 'first')
+    assert cached.urls == log_stats.urls
+    assert cached.time_sums == log_stats.time_sums
+
+    os.utime(os.path.join(cache_dir, 'first.pickle'), (0, 0))
+    save_cached_stats(cache_dir, 'second', log_stats, 10 ** 9)
+    evict_cache(cache_dir, os.path.getsize(os.path.join(cache_dir, 'second.pickle')))
+    assert load_cached_stats(cache_dir, 'first') is None
+    assert load_cached_stats(cache_dir, 'second') is not None
+
+    clear_cache(cache_dir)
+    assert load_cached_stats(cache_dir, 'second') is None
+
+
+def test_build_log_stats_uses_cache(tmp_path, mock_log_file_list):
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_text(''.join(mock_log_file_list))
+    conf = {**CONFIG, 'CACHE_DIR': str(tmp_path / 'cache')}
+
+    first = build_log_stats(str(log), conf)
+    assert len(os.listdir(conf['CACHE_DIR'])) == 1
+    cached = build_log_stats(str(log), conf)
+    assert cached.urls == first.urls
+    assert cached.counts == first.counts
+
+
+def test_cache_dir_defaults_to_report_dir(tmp_path, mock_log_file_list):
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_text(''.join(mock_log_file_list))
+    report_dir = tmp_path / 'reports'
+    conf = {**CONFIG, 'REPORT_DIR': str(report_dir)}
+
+    assert get_cache_dir(conf) == str(report_dir / '.cache')
+    assert get_cache_dir({**conf, 'CACHE_DIR': ''}) == ''
+    build_log_stats(str(log), conf)
+    assert len(os.listdir(report_dir / '.cache')) == 1
+    assert os.stat(report_dir / '.cache').st_mode & 0o077 == 0
+
+
+def test_log_follower(tmp_path):
+    log = tmp_path / 'nginx-access-ui.log'
+    follower = LogFollower(str(log))
+    assert follower.read_lines() == []
+
+    with open(log, 'wb') as f:
+        f.write(b'first\nsecond\nthi')
+    assert follower.read_lines() == [b'first', b'second']
+    assert follower.check_rotation() is None
+
+    with open(log, 'ab') as f:
+        f.write(b'rd\nfourth\n')
+    assert follower.read_lines() == [b'third', b'fourth']
+    assert follower.offset == log.stat().st_size
+
+    with open(log, 'ab') as f:
+        f.write(b'fifth\nsix')
+    os.rename(log, tmp_path / 'nginx-access-ui.log-20170630')
+    with open(log, 'wb') as f:
+        f.write(b'new\n')
+    assert follower.check_rotation() == [b'fifth', b'six']
+    assert follower.read_lines() == [b'new']
+
+    with open(log, 'wb') as f:
+        f.write(b'\n')
+    assert follower.check_rotation() == []
+    assert follower.read_lines() == [b'']
+    follower.close()
+
+
+def test_log_follower_reads_in_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr('log_analyzer.READ_BUFFER_SIZE', 4)
+    log = tmp_path / 'nginx-access-ui.log'
+    log.write_bytes(b'first\nsecond\nthi')
+    follower = LogFollower(str(log))
+
+    chunks = list(follower.read_chunks())
+    assert len(chunks) == 4
+    assert [line for lines in chunks for line in lines] == [b'first', b'second']
+    assert follower.offset == log.stat().st_size
+
+    with open(log, 'ab') as f:
+        f.write(b'rd\n')
+    assert follower.read_lines() == [b'third']
+    follower.close()
+
+
+def test_follow_log_survives_parse_errors(tmp_path, monkeypatch, mock_log_file_list):
+    class StopFollowing(Exception):
+        pass
+
+    def stop(interval):
+        raise StopFollowing
+
+    log = tmp_path / 'nginx-access-ui.log'
+    log.write_text('broken line\n' * 10 + ''.join(mock_log_file_list))
+    conf = {**CONFIG, 'FOLLOW_LOG': str(log), 'REPORT_DIR': str(tmp_path), 'ERROR_SAMPLE_SIZE': 10}
+    monkeypatch.setattr('log_analyzer.time.sleep', stop)
+
+    with pytest.raises(StopFollowing):
+        follow_log(conf)
+    assert os.path.exists(tmp_path / LIVE_REPORT_NAME)
+    with open(tmp_path / get_report_data_name(LIVE_REPORT_NAME)) as f:
+        assert '/api/v2/banner/25019354' in f.read()
+
+
+def test_get_pending_logs(create_log_files, create_report_dir):
+    log_files = get_log_files('./log_tmp')
+    assert get_pending_logs(log_files, create_report_dir) == log_files
+    assert get_pending_logs(log_files, create_report_dir, date(2019, 1, 1)) == log_files[:1]
+
+    open(os.path.join(create_report_dir, 'report-2019.06.30.html'), 'a').close()
+    assert get_pending_logs(log_files, create_report_dir) == log_files[1:]
+
+
+def test_get_pending_logs_sampled(tmp_path, create_log_files, create_report_dir):
+    log_files = get_log_files('./log_tmp')
+    open(os.path.join(create_report_dir, 'report-2019.06.30.html'), 'a').close()
+    index = LogIndex(str(tmp_path / 'index.json'))
+    for log_index in (None, index):
+        # Полный отчет за день не заменяет отчет по выборке
+        assert get_pending_logs(log_files, create_report_dir, index=log_index, sample_rate=0.1) == log_files
+
+    open(os.path.join(create_report_dir, 'report-2019.06.30.sample.html'), 'a').close()
+    for log_index in (None, index):
+        assert get_pending_logs(log_files, create_report_dir, index=log_index, sample_rate=0.1) == log_files[1:]
+    assert index.is_reported(log_files[0].filename, create_report_dir)
+
+
+def test_backfill(tmp_path, mock_log_file_list, create_report_dir):
+    log_dir = tmp_path / 'log'
+    log_dir.mkdir()
+    for day in ('20170629', '20170630'):
+        with gzip.open(log_dir / f'nginx-access-ui.log-{day}.gz', 'wt') as f:
+            f.writelines(mock_log_file_list)
+    (log_dir / 'nginx-access-ui.log-20170701').write_text('broken\n')
+
+    conf = {**CONFIG, 'WORKERS': 2, 'REPORT_SIZE': 5, 'REPORT_DIR': create_report_dir, 'CACHE_DIR': ''}
+    results = backfill(get_log_files(str(log_dir)), conf)
+    assert sorted((os.path.basename(log), is_success) for log, is_success, _ in results) == [
+        ('nginx-access-ui.log-20170629.gz', True),
+        ('nginx-access-ui.log-20170630.gz', True),
+        ('nginx-access-ui.log-20170701', False),
+    ]
+    assert sorted(os.listdir(create_report_dir)) == [
+        'report-2017.06.29.data.js', 'report-2017.06.29.html', 'report-2017.06.30.data.js', 'report-2017.06.30.html'
+    ]
+
+
+@pytest.mark.parametrize('median_mode', ['exact', 'approx'])  # noqa
+def test_rollup(tmp_path, mock_log_file_list, median_mode):
+    log_dir = tmp_path / 'log'
+    log_dir.mkdir()
+    for day in ('20170629', '20170630', '20170701'):
+        with gzip.open(log_dir / f'nginx-access-ui.log-{day}.gz', 'wt') as f:
+            f.writelines(mock_log_file_list)
+
+    conf = {**CONFIG, 'MEDIAN_MODE': median_mode, 'CACHE_DIR': str(tmp_path / 'cache')}
+    log_files = get_log_files(str(log_dir))
+    day_stats = build_log_stats(log_files[0].filename, conf)
+    result = rollup(log_files, conf)
+
+    assert result.requests_count == 3 * day_stats.requests_count
+    assert list(result.urls) == list(day_stats.urls)
+    assert list(result.counts) == [3 * count for count in day_stats.counts]
+    assert [t.median() for t in result.times] == [t.median() for t in day_stats.times]
+    assert get_rollup_report_name(log_files) == 'report-rollup-2017.06.29-2017.07.01.html'
+
+
+def test_rollup_checks_errors(tmp_path, mock_log_file_list):
+    log_dir = tmp_path / 'log'
+    log_dir.mkdir()
+    (log_dir / 'nginx-access-ui.log-20170629').write_text(''.join(mock_log_file_list))
+    (log_dir / 'nginx-access-ui.log-20170630').write_text('broken\n' * len(mock_log_file_list))
+
+    conf = {**CONFIG, 'CACHE_DIR': str(tmp_path / 'cache')}
+    with pytest.raises(LogParseError, match='nginx-access-ui.log-20170630'):
+        rollup(get_log_files(str(log_dir)), conf)
+
+
+def test_get_data_for_render_ties():
+    log_stats = LogStats()
+    log_stats.requests_count = 4
+    for url in ('/a', '/b', '/c', '/d'):
+        log_stats.add(url, '0.100')
+
+    result = get_data_for_render(log_stats, 2)
+    assert [row['url'] for row in result] == ['/a', '/b']
+
+
+@pytest.mark.parametrize('url, result', [  # noqa
+    ('/api/v2/banner/23640143', '/api/v2/banner/{id}'),
+    ('/api/v2/banner/23640143/statistic/?date_from=2017-06-29', '/api/v2/banner/{id}/statistic/?date_from=2017-06-29'),
+    ('/capacity_progress/?task_id=e8f34cfb862f460fa39287f062c61f65&_=1498756373389', '/capacity_progress/?task_id={id}'),
+    ('/api/1/campaigns/?id=512672', '/api/{id}/campaigns/?id={id}'),
+    ('/api/v2/internal/banner/24294027/info', '/api/v2/internal/banner/{id}/info'),
+    ('/export/appinstall_raw/2017-06-29/', '/export/appinstall_raw/2017-06-29/'),
+    ('/accepted/?_=1', '/accepted/'),
+])
+def test_url_normalizer(url, result):
+    assert UrlNormalizer(['_'])(url) == result
+
+
+def test_url_normalizer_rewrites():
+    rewrites = parse_url_rewrites('''
+        ^/agency/outgoings_stats/.* => /agency/outgoings_stats/
+        date_from=[^&]* => date_from={date}
+    ''')
+    normalizer = UrlNormalizer(rewrites=rewrites)
+    assert normalizer('/agency/outgoings_stats/?date1=29-06-2017&oi=26647045') == '/agency/outgoings_stats/'
+    assert normalizer('/stat/?date_from=2017-06-29&x=1') == '/stat/?date_from={date}&x={id}'
+
+
+def test_log_stats_max_keys(mock_logs_data):
+    log_stats = LogStats(max_keys=3)
+    for url, request_time in mock_logs_data:
+        log_stats.add(url, request_time)
+
+    assert list(log_stats.urls) == [url for url, _ in mock_logs_data[:3]] + [OTHER_URL]
+    assert sum(log_stats.counts) == len(mock_logs_data)
+    assert log_stats.counts[log_stats.urls[OTHER_URL]] == len(mock_logs_data) - 3
+
+
+def test_create_log_stats_normalize(mock_logs_data):
+    log_stats = create_log_stats({**CONFIG, 'URL_NORMALIZE': 'true'})
+    for url, request_time in mock_logs_data:
+        log_stats.add(url, request_time)
+
+    assert log_stats.counts[log_stats.urls['/api/v2/banner/{id}']] == 7
+    assert log_stats.parsed_count == len(mock_logs_data)
+
+
+@pytest.mark.parametrize('gzip_backend', ['python', 'thread', 'zcat', 'pigz', 'auto'])  # noqa
+def test_unpack_file_gzip_backends(tmp_path, mock_log_file_list, gzip_backend):
+    log = tmp_path / 'nginx-access-ui.log-20170630.gz'
+    # Архив из нескольких gzip-потоков подряд, как после дописывания через cat
+    log.write_bytes(
+        gzip.compress(''.join(mock_log_file_list).encode()) + gzip.compress(mock_log_file_list[0].encode())
+    )
+
+    result = list(unpack_file(str(log), gzip_backend=gzip_backend))
+    assert result == mock_log_file_list + mock_log_file_list[:1]
+
+
+@pytest.mark.parametrize('gzip_backend', ['python', 'thread', 'zcat', 'pigz', 'auto'])  # noqa
+def test_unpack_file_truncated_gzip(tmp_path, mock_log_file_list, gzip_backend):
+    log = tmp_path / 'nginx-access-ui.log-20170630.gz'
+    log.write_bytes(gzip.compress(''.join(mock_log_file_list * 50).encode())[:-100])
+
+    with pytest.raises(EOFError):
+        list(unpack_file(str(log), gzip_backend=gzip_backend))
+
+
+@pytest.mark.parametrize('gzip_backend', ['python', 'thread', 'zcat', 'pigz', 'auto'])  # noqa
+def test_unpack_file_empty_gzip(tmp_path, gzip_backend):
+    log = tmp_path / 'nginx-access-ui.log-20170630.gz'
+    log.write_bytes(b'')
+
+    assert list(unpack_file(str(log), gzip_backend=gzip_backend)) == []
+
+
+@pytest.fixture()
+def mixed_log(tmp_path, mock_log_file_list):
+    lines = [line.encode() for line in mock_log_file_list]
+    lines[2] = lines[2].replace(b'/api/', b'/\xff\xfe/')
+    lines[5] = b'broken line\n'
+    lines.insert(7, b'\n')
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    # Последняя строка без перевода строки
+    log.write_bytes(b''.join(lines * 3).rstrip(b'\n'))
+    return str(log)
+
+
+def test_pars_log_mmap(mixed_log, monkeypatch):
+    monkeypatch.setattr('log_analyzer.MMAP_BLOCK_SIZE', 500)
+    expected = get_log_data(mixed_log, pars_log_bytes, decode=False)
+    result = pars_log_mmap(mixed_log)
+    assert result.requests_count == expected.requests_count == 33
+    assert result.parsed_count == expected.parsed_count == 24
+    assert result.urls == expected.urls
+    assert result.time_sums == expected.time_sums
+
+    first_chunk, second_chunk = get_file_chunks(mixed_log, 2)
+    first = pars_log_mmap(mixed_log, *first_chunk)
+    first.merge(pars_log_mmap(mixed_log, *second_chunk))
+    assert first.requests_count == expected.requests_count
+    assert first.counts == expected.counts
+
+
+def test_get_log_data_mmap(mixed_log):
+    expected = get_log_data(mixed_log, pars_log_bytes, decode=False)
+    for workers in (1, 3):
+        result = get_log_data(mixed_log, pars_log_bytes, workers=workers, decode=False, use_mmap=True)
+        assert result.requests_count == expected.requests_count
+        assert result.counts == expected.counts
+
+
+def test_pars_log_mmap_empty(tmp_path):
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_bytes(b'')
+    assert pars_log_mmap(str(log)).requests_count == 0
+
+
+def test_metrics(tmp_path, mock_log_file_list, create_report_dir):
+    log = tmp_path / 'nginx-access-ui.log-20170630.gz'
+    with gzip.open(log, 'wt') as f:
+        f.writelines(mock_log_file_list)
+    metrics = Metrics()
+
+    assert get_log_files(str(tmp_path), metrics)
+    log_stats = get_log_data(str(log), pars_log_bytes, decode=False, metrics=metrics)
+    data = get_data_for_render(log_stats, 5, metrics)
+    create_report('report-2017.06.30.html', data, create_report_dir, metrics)
+
+    result = metrics.as_dict()
+    assert list(result['stages']) == ['listing', 'parse', 'render', 'report']
+    assert result['lines_read'] == result['lines_parsed'] == 10
+    assert result['lines_failed'] == 0
+    assert result['bytes_decompressed'] == len(''.join(mock_log_file_list))
+    assert result['bytes_read'] == log.stat().st_size
+    assert result['distinct_urls'] == 10
+    assert result['peak_rss_bytes'] > 0
+
+    metrics.write(str(tmp_path / 'metrics.prom'))
+    prom = (tmp_path / 'metrics.prom').read_text()
+    assert 'log_analyzer_stage_seconds{stage="parse"}' in prom
+    assert 'log_analyzer_lines_read 10\n' in prom
+    # Файл читает textfile collector node_exporter, который обычно работает от другого пользователя
+    assert os.stat(tmp_path / 'metrics.prom').st_mode & 0o777 == 0o644
+
+    metrics.write(str(tmp_path / 'metrics.json'))
+    with open(tmp_path / 'metrics.json') as f:
+        assert json.load(f)['lines_parsed'] == 10
+
+
+@pytest.fixture()
+def broken_log(tmp_path, mock_log_file_list):
+    """Лог, в котором после 20 корректных строк идет 10000 нераспарсенных."""
+    lines = mock_log_file_list[:20] + [f'garbage {i}\n' for i in range(10000)]
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_text(''.join(lines))
+    return str(log)
+
+
+def test_error_monitor_early_abort(broken_log):
+    read = []
+
+    def parser(line):
+        read.append(line)
+        return pars_log_bytes(line)
+
+    log_stats = LogStats(error_monitor=ErrorMonitor(threshold=50, sample_size=100))
+    with pytest.raises(LogParseError) as e:
+        get_log_data(broken_log, parser, decode=False, log_stats=log_stats)
+    assert len(read) == 100
+    assert 'из 100 прочитанных строк' in str(e.value)
+    assert "b'garbage 0\\n'" in str(e.value)
+    assert len(log_stats.error_monitor.examples) == 5
+
+
+@pytest.mark.parametrize('workers', [1, 2])  # noqa
+def test_error_monitor_mmap(broken_log, monkeypatch, workers):
+    monkeypatch.setattr('log_analyzer.MMAP_BLOCK_SIZE', 4096)
+    log_stats = LogStats(error_monitor=ErrorMonitor(threshold=50, sample_size=100))
+    with pytest.raises(LogParseError, match='garbage'):
+        get_log_data(broken_log, pars_log_bytes, workers, decode=False, log_stats=log_stats, use_mmap=True)
+
+
+def test_error_monitor_final_check(mixed_log):
+    log_stats = create_log_stats(DEFAULT_CONFIG)
+    get_log_data(mixed_log, pars_log_bytes, decode=False, log_stats=log_stats)
+    log_stats.check_errors(final=True)
+
+    log_stats.error_monitor.threshold = 20
+    with pytest.raises(LogParseError, match="broken line"):
+        log_stats.check_errors(final=True)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])  # noqa
+def test_error_monitor_examples(mixed_log, use_mmap):
+    log_stats = LogStats(error_monitor=ErrorMonitor(threshold=20, sample_size=10 ** 6))
+    get_log_data(mixed_log, pars_log_bytes, decode=False, log_stats=log_stats, use_mmap=use_mmap)
+
+    examples = [line.rstrip(b'\n') for line in log_stats.error_monitor.examples]
+    assert examples[1:3] == [b'broken line', b'']
+    assert b'/\xff\xfe/' in examples[0]
+    with pytest.raises(LogParseError, match="broken line"):
+        log_stats.check_errors(final=True)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])  # noqa
+def test_build_report_combined_format(combined_log, create_report_dir, use_mmap):
+    log_stats = LogStats(error_monitor=ErrorMonitor(threshold=20, sample_size=10 ** 6))
+    get_log_data(str(combined_log), pars_log_bytes, decode=False, log_stats=log_stats, use_mmap=use_mmap)
+    assert (log_stats.requests_count, log_stats.parsed_count) == (20, 0)
+    assert b'Firefox/3.0' in log_stats.error_monitor.examples[0]
+
+    conf = {**CONFIG, 'REPORT_DIR': create_report_dir, 'CACHE_DIR': '', 'MMAP': use_mmap}
+    assert not build_report(str(combined_log), conf)
+    assert os.listdir(create_report_dir) == []
+
+
+def test_error_threshold_not_cached(tmp_path, mixed_log):
+    conf = {**CONFIG, 'CACHE_DIR': str(tmp_path / 'cache')}
+    build_log_stats(mixed_log, conf).check_errors(final=True)
+
+    cached = build_log_stats(mixed_log, {**conf, 'ERROR_THRESHOLD': 20})
+    assert len(os.listdir(conf['CACHE_DIR'])) == 1
+    assert cached.error_monitor.threshold == 20
+    with pytest.raises(LogParseError, match="broken line"):
+        cached.check_errors(final=True)
+
+
+def test_build_report_empty_log(tmp_path, create_report_dir):
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_text('')
+    conf = {**CONFIG, 'REPORT_DIR': create_report_dir, 'CACHE_DIR': ''}
+
+    assert not build_report(str(log), conf)
+    assert os.listdir(create_report_dir) == []
+
+
+@pytest.fixture()
+def weighted_log(tmp_path):
+    """Лог из 20000 уникальных строк, урлы встречаются с разной частотой и разным временем ответа."""
+    rnd = random.Random(5)
+    urls = [(f'/api/v2/banner/{i}', 0.05 * (i + 1)) for i in range(5)]
+    lines = []
+    for i in range(20000):
+        url, mean = rnd.choices(urls, weights=[40, 25, 20, 10, 5])[0]
+        lines.append(
+            f'1.1.1.{i % 256} -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" "-" "-" '
+            f'"1498697422-{i}" "-" {rnd.expovariate(1 / mean):.3f}\n'
+        )
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_text(''.join(lines))
+    return str(log)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])  # noqa
+def test_get_log_data_sampled_small_log(tmp_path, weighted_log, use_mmap):
+    # Лог меньше двух блоков SAMPLE_BLOCK_SIZE: читается целый первый блок, а не доля sample_rate
+    log = tmp_path / 'nginx-access-ui.log-20170701'
+    with open(weighted_log) as f:
+        log.write_text(''.join(f.readlines()[:3000]))
+    log_stats = get_log_data(
+        str(log), pars_log_bytes, decode=False, log_stats=LogStats(sample_rate=0.1), use_mmap=use_mmap
+    )
+    assert 0 < log_stats.sampled_fraction <= 1
+    data = get_data_for_render(log_stats, 10)
+    assert sum(row['count'] for row in data) == pytest.approx(3000, rel=0.25)
+
+
+def test_get_sampled_blocks(weighted_log, monkeypatch):
+    monkeypatch.setattr('log_analyzer.SAMPLE_BLOCK_SIZE', 4096)
+    with open(weighted_log, 'rb') as f:
+        mm = f.read()
+    blocks = list(get_sampled_blocks(mm, 0, len(mm), 0.25))
+    blocks_count = -(-len(mm) // 4096)
+    assert abs(len(blocks) - blocks_count / 4) <= 1
+    assert blocks[0][0] == 0
+    for start, end in blocks:
+        assert start == 0 or mm[start - 1:start] == b'\n'
+        assert mm[end - 1:end] == b'\n'
+
+    # Части файла выбирают те же блоки, что и чтение целиком
+    chunks = get_file_chunks(weighted_log, 3)
+    chunk_blocks = [block for start, end in chunks for block in get_sampled_blocks(mm, start, end, 0.25)]
+    assert b''.join(mm[start:end] for start, end in chunk_blocks) == b''.join(mm[start:end] for start, end in blocks)
+
+
+@pytest.mark.parametrize('use_mmap, workers', [(False, 1), (True, 1), (True, 3)])  # noqa
+def test_get_log_data_sampled(weighted_log, monkeypatch, use_mmap, workers):
+    monkeypatch.setattr('log_analyzer.SAMPLE_BLOCK_SIZE', 4096)
+    full = get_data_for_render(get_log_data(weighted_log, pars_log_bytes, decode=False), 10)
+    log_stats = get_log_data(
+        weighted_log, pars_log_bytes, workers, decode=False, log_stats=LogStats(sample_rate=0.25), use_mmap=use_mmap
+    )
+    assert 3000 < log_stats.requests_count < 7000
+    sampled = {row['url']: row for row in get_data_for_render(log_stats, 10)}
+    assert len(sampled) == 5
+    for row in full:
+        estimate = sampled[row['url']]
+        assert estimate['count'] == pytest.approx(row['count'], rel=0.25)
+        assert estimate['time_sum'] == pytest.approx(row['time_sum'], rel=0.25)
+        assert 0 < estimate['count_perc_ci'] < 5
+        assert 0 < estimate['time_perc_ci'] < 5
+        if not use_mmap:
+            # Интервалы построены для независимого отбора строк
+            assert abs(estimate['count_perc'] - row['count_perc']) < 2 * estimate['count_perc_ci']
+            assert abs(estimate['time_perc'] - row['time_perc']) < 2 * estimate['time_perc_ci']
+    assert 'count_perc_ci' not in full[0]
+
+
+@pytest.fixture()
+def fleet_log_dirs(tmp_path, mock_log_file_list):
+    """Три хоста с логами за 29 и 30 июня; у третьего хоста лог за 30 июня в неверном формате."""
+    for host in ('web1', 'web2', 'web3'):
+        host_dir = tmp_path / 'nginx' / host
+        host_dir.mkdir(parents=True)
+        for day in ('20170629', '20170630'):
+            with gzip.open(host_dir / f'nginx-access-ui.log-{day}.gz', 'wt') as f:
+                if host == 'web3' and day == '20170630':
+                    f.write('broken\n' * 10)
+                else:
+                    f.writelines(mock_log_file_list)
+    (tmp_path / 'nginx' / 'readme.txt').touch()
+    return tmp_path / 'nginx'
+
+
+def test_get_log_dirs(fleet_log_dirs):
+    assert get_log_dirs({'LOG_DIR': './log', 'LOG_DIRS': ''}) == ['./log']
+    log_dirs = get_log_dirs({'LOG_DIRS': f'{fleet_log_dirs}/*, {fleet_log_dirs}/web1\n{fleet_log_dirs}/missing*'})
+    assert log_dirs == [str(fleet_log_dirs / host) for host in ('web1', 'web2', 'web3')]
+
+
+def test_build_fleet_report(fleet_log_dirs, create_report_dir):
+    days = get_fleet_log_files(get_log_dirs({'LOG_DIRS': f'{fleet_log_dirs}/*'}))
+    assert [(day.date, len(day.filenames)) for day in days] == [(date(2017, 6, 30), 3), (date(2017, 6, 29), 3)]
+
+    conf = {**CONFIG, 'WORKERS': 2, 'CACHE_DIR': '', 'REPORT_DIR': create_report_dir}
+    log_stats = build_fleet_log_stats(days[1].filenames, conf)
+    expected = LogStats()
+    for log in days[1].filenames:
+        expected.merge(get_log_data(log, pars_log_bytes, decode=False))
+    assert log_stats.requests_count == expected.requests_count
+    assert dict(log_stats.urls) == dict(expected.urls)
+    assert log_stats.counts == expected.counts
+    assert log_stats.time_sums == expected.time_sums
+
+    # Лог с ошибками: отчет без части источников не публикуется, день останется необработанным
+    with pytest.raises(LogParseError, match='nginx-access-ui.log-20170630'):
+        build_fleet_log_stats(days[0].filenames, conf)
+    assert not build_fleet_report(days[0], conf)
+    assert os.listdir(create_report_dir) == []
+
+    assert build_fleet_report(days[1], {**conf, 'WORKERS': 1})
+    assert sorted(os.listdir(create_report_dir)) == ['report-2017.06.29.data.js', 'report-2017.06.29.html']
+
+
+def test_get_fleet_workers():
+    logs = [f'host{i}/nginx-access-ui.log-20170630' for i in range(40)]
+    cpu_count = os.cpu_count() or 1
+    assert get_fleet_workers(logs, {'WORKERS': 1}) == min(40, cpu_count)
+    assert get_fleet_workers(logs[:2], {'WORKERS': 1}) == min(2, cpu_count)
+    assert get_fleet_workers(logs, {'WORKERS': 64}) == 40
+
+
+def test_log_format_parser_default(mock_log_file_list):
+    parser = LogFormatParser(DEFAULT_LOG_FORMAT)
+    for line in mock_log_file_list:
+        line = line.encode()
+        assert parser(line) == [(url, float(request_time)) for url, request_time in pars_log_bytes(line)]
+    assert parser(b'broken line\n') == []
+
+
+def test_log_format_parser_fields():
+    log_format = parse_log_format("""
+        '$remote_addr [$time_local] "$request" $status '
+        '"$upstream_response_time" $host $request_time'
+    """)
+    assert log_format == '$remote_addr [$time_local] "$request" $status "$upstream_response_time" $host $request_time'
+    parser = LogFormatParser(log_format, ('method', 'status_class', 'host'), 'upstream_response_time')
+    assert set(parser.pattern.groupindex) == {'method', 'url', 'status', 'upstream_response_time', 'host'}
+    line = b'1.1.1.1 [29/Jun/2017:03:50:22 +0300] "POST /api/v2/banner HTTP/1.1" 502 "0.100, 0.250" ui 0.400\n'
+    assert parser(line) == [('/api/v2/banner', 0.35, 'POST\t5xx\tui')]
+    assert parser(line.replace(b'"0.100, 0.250"', b'"-"')) == []
+
+    with pytest.raises(ValueError, match='upstream_addr'):
+        LogFormatParser(log_format, ('upstream_addr',))
+    with pytest.raises(ValueError, match='request_uri'):
+        LogFormatParser('$remote_addr $request_time')
+    with pytest.raises(ValueError, match='request'):
+        LogFormatParser(log_format, ('request',))
+
+
+def test_log_format_parser_request_method():
+    parser = LogFormatParser('$request_method "$request" $request_time', ('method',))
+    assert 'request_method' in parser.pattern.groupindex and 'method' not in parser.pattern.groupindex
+    assert parser(b'PUT "GET /api HTTP/1.1" 0.1\n') == [('/api', 0.1, 'PUT')]
+
+
+def test_log_format_parser_repeated_variable():
+    parser = LogFormatParser('$host "$request" $host $request_time', ('host',))
+    assert parser(b'ui "GET /api HTTP/1.1" ui 0.1\n') == [('/api', 0.1, 'ui')]
+    parser = LogFormatParser('"$request" "$request" $request_time $request_time')
+    assert parser(b'"GET /api HTTP/1.1" "GET /api HTTP/1.1" 0.1 0.1\n') == [('/api', 0.1)]
+
+
+def test_get_parser():
+    assert get_parser(DEFAULT_CONFIG) is pars_log_bytes
+    parser = get_parser({**DEFAULT_CONFIG, 'GROUP_BY': 'status_class'})
+    assert parser is get_parser({**DEFAULT_CONFIG, 'GROUP_BY': 'status_class'})
+    assert parser.log_format == DEFAULT_LOG_FORMAT and parser.group_by == ('status_class',)
+
+
+@pytest.mark.parametrize('use_mmap, workers', [(False, 1), (True, 1), (True, 2)])  # noqa
+def test_get_log_data_group_by(mixed_log, use_mmap, workers):
+    conf = {**DEFAULT_CONFIG, 'GROUP_BY': 'method, status_class'}
+    expected = get_log_data(mixed_log, pars_log_bytes, decode=False)
+    log_stats = get_log_data(
+        mixed_log, get_parser(conf), workers, decode=False, log_stats=create_log_stats(conf), use_mmap=use_mmap
+    )
+    assert log_stats.requests_count == expected.requests_count
+    assert log_stats.parsed_count == expected.parsed_count
+    assert {url.split('\t')[0] for url in log_stats.urls} == set(expected.urls)
+
+    data = get_data_for_render(log_stats, 100)
+    assert {(row['method'], row['status_class']) for row in data} == {('GET', '2xx')}
+    assert sum(row['count'] for row in data) == expected.parsed_count
+
+
+@pytest.mark.parametrize('compress', [False, True])  # noqa
+def test_write_export(tmp_path, data_for_render_result, compress):
+    path = str(tmp_path / 'report-2017.06.30.agg')
+    for row in data_for_render_result:
+        row['method'] = 'GET'
+    write_export(path, data_for_render_result, compress)
+
+    with ExportReader(path) as reader:
+        assert reader.rows_count == len(data_for_render_result)
+        assert list(reader.columns) == list(data_for_render_result[0])
+        assert reader.to_rows() == data_for_render_result
+        indices, dictionary = reader.get_dictionary('method')
+        assert dictionary == ['GET'] and set(indices) == {0}
+        counts = reader['count']
+        if not compress:
+            # Колонка читается прямо из отображения файла
+            assert isinstance(counts, memoryview) and counts.readonly
+        assert list(counts) == [row['count'] for row in data_for_render_result]
+        counts.release()
+
+
+def test_write_export_column_types(tmp_path, data_for_render_result):
+    path = str(tmp_path / 'report-2017.06.30.agg')
+    for row in data_for_render_result:
+        row['time_perc'] = 0
+    write_export(path, data_for_render_result)
+
+    with ExportReader(path) as reader:
+        assert reader.columns['count'][0] == b'q' and reader.columns['url'][0] == b'U'
+        assert reader.columns['time_perc'][0] == b'd'
+        assert reader.columns['time_avg'][0] == b'd'
+        assert list(reader['time_perc']) == [0.0] * len(data_for_render_result)
+
+
+def test_export_reader_invalid(tmp_path):
+    path = tmp_path / 'broken.agg'
+    path.write_bytes(b'not an export file')
+    with pytest.raises(ValueError, match='Неизвестный формат'):
+        ExportReader(str(path))
+
+
+def test_build_report_export(tmp_path, mock_log_file_list, create_report_dir):
+    log = tmp_path / 'nginx-access-ui.log-20170630'
+    log.write_text(''.join(mock_log_file_list))
+    export_dir = str(tmp_path / 'export')
+    conf = {
+        **CONFIG, 'REPORT_SIZE': 3, 'REPORT_DIR': create_report_dir, 'CACHE_DIR': '',
+        'EXPORT_DIR': export_dir, 'GROUP_BY': 'status_class',
+    }
+    assert build_report(str(log), conf)
+
+    log_stats = get_log_data(str(log), pars_log_bytes, decode=False)
+    with ExportReader(os.path.join(export_dir, get_export_name('report-2017.06.30.html'))) as reader:
+        rows = reader.to_rows()
+    assert len(rows) == len(log_stats.urls) > 3
+    assert {row['status_class'] for row in rows} == {'2xx'}
+    assert sum(row['count'] for row in rows) == log_stats.parsed_count
@@ -0,0 +1,39 @@
+import gzip
+import pytest
+
+from benchmark import generate_log, run_benchmark
+from log_analyzer import Metrics, get_log_data, pars_log_bytes
+
+
+@pytest.mark.parametrize('compress', [False, True])  # noqa
+def test_generate_log(tmp_path, compress):
+    name = 'nginx-access-ui.log-20170630' + ('.gz' if compress else '')
+    first, second = tmp_path / ('1' + name), tmp_path / ('2' + name)
+    lines = generate_log(str(first), 0.2, urls=50, seed=1, compress=compress)
+    generate_log(str(second), 0.2, urls=50, seed=1, compress=compress)
+
+    read = gzip.open if compress else open
+    with read(first, 'rb') as f1, read(second, 'rb') as f2:
+        assert f1.read() == f2.read()
+
+    log_stats = get_log_data(str(first), pars_log_bytes, decode=False)
+    assert log_stats.requests_count == log_stats.parsed_count == lines
+    assert len(log_stats.urls) <= 50
+
+
+def test_run_benchmark(tmp_path, monkeypatch):
+    lines = generate_log(str(tmp_path / 'nginx-access-ui.log-20170630.gz'), 0.1, urls=20, compress=True)
+    runs = []
+    monkeypatch.setattr('benchmark.Metrics', lambda: runs.append(Metrics()) or runs[-1])
+    result = run_benchmark(str(tmp_path), report_size=5)
+    stages = result['stages']
+    assert list(stages) == ['listing', 'decompress', 'pars_log', 'aggregate', 'parse', 'render', 'report']
+    assert stages['parse']['lines_per_second'] > 0
+    assert stages['decompress']['mb_per_second'] > 0
+    assert result['total_seconds'] == pytest.approx(
+        sum(stages[name]['seconds'] for name in ('listing', 'parse', 'render', 'report'))
+    )
+    # Разобранные строки учитываются в метриках один раз
+    assert runs[0].values['lines_read'] == runs[0].values['lines_parsed'] == lines
+    assert result['lines'] == result['parsed'] > 0
+    assert result['peak_rss_mb'] > 0